@@ -1,15 +1,20 @@
 import pandas as pd
 import mysql.connector
 import os
-import urllib.request
+import shutil
+import urllib3
 import yaml
-import cv2
-from utils import refresh_folder
+from concurrent.futures import ThreadPoolExecutor
+from utils import refresh_folder, probe_fps
 
 # Load dictionary of constants stored in config.yml & db credentials in database_config.yml
 cfg = yaml.full_load(open(os.path.join(os.getcwd(), "../../config.yml"), 'r'))['PREPROCESS']
 database_cfg = yaml.full_load(open(os.path.join(os.getcwd(), "../../database_config.yml"), 'r'))
 
+# Connection pool shared by all download threads, so that TCP/TLS connections are reused across requests
+POOL = urllib3.PoolManager(num_pools=8, maxsize=32,
+                           retries=urllib3.Retry(3, status_forcelist=(500, 502, 503, 504), raise_on_status=True))
+
 
 def download(df, sliding, fr_rows, video_out_root_folder=cfg['PATHS']['UNMASKED_VIDEOS'],
              csv_out_folder=cfg['PATHS']['CSVS_OUTPUT'], base_fr=cfg['PARAMS']['BASE_FR']):
@@ -59,18 +64,36 @@ def download(df, sliding, fr_rows, video_out_root_folder=cfg['PATHS']['UNMASKED_
 
     print('Writing ' + str(num_rows) + ' videos to ' + video_out_folder + '...')
 
-    # Iterate through df to download the videos and preserve their id in the name
-    for index, row in df.iterrows():
-        out_path = video_out_folder + row['id'] + '.mp4'
-        urllib.request.urlretrieve(row['s3_path'], out_path)
-
-        # Get frame rate
-        cap = cv2.VideoCapture(out_path)
-        fr = round(cap.get(cv2.CAP_PROP_FPS))
-        cap.release()
-
-        # Discard video if frame rate is not multiple of base frame rate
-        fr_rows.append([row['id'], fr])
+    def fetch(clip_id, s3_path):
+        '''
+        Downloads a single video and returns its [id, frame rate] row
+
+        :param clip_id: ID of the video to download
+        :param s3_path: URL of the video to download
+        '''
+        out_path = video_out_folder + clip_id + '.mp4'
+        r = POOL.request('GET', s3_path, preload_content=False)
+        try:
+            # Don't save an error response (e.g. for an expired or forbidden URL) as a video
+            if r.status != 200:
+                raise urllib3.exceptions.HTTPError('HTTP ' + str(r.status) + ' downloading ' + clip_id)
+            with open(out_path, 'wb') as f:
+                shutil.copyfileobj(r, f, 1 << 20)
+
+                # Drop the written video from the page cache, so that concurrent downloads don't evict each other
+                if hasattr(os, 'posix_fadvise'):  # Not available on Windows
+                    f.flush()
+                    os.fdatasync(f.fileno())  # Only clean pages can be dropped
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            r.release_conn()
+
+        # Get frame rate (runs in this worker, overlapping with other in-flight downloads)
+        return [clip_id, probe_fps(out_path)]
+
+    # Download the videos concurrently (preserving their id in the name), keeping frame rate rows in df order
+    with ThreadPoolExecutor(max_workers=cfg['PARAMS']['DOWNLOAD_WORKERS']) as executor:
+        fr_rows.extend(executor.map(fetch, df['id'], df['s3_path']))
 
 
 # Get database configs
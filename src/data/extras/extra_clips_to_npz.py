@@ -4,9 +4,13 @@ import pandas as pd
 import os
 import yaml
 import argparse
-from utils import refresh_folder
+from multiprocessing import Pool
+from utils import refresh_folder, sorted_flow_frames, collect_rows
 
-cfg = yaml.full_load(open(os.path.join(os.getcwd(), "../../config.yml"), 'r'))['PREPROCESS']
+# Config is found relative to this file rather than the cwd, and parsed with LibYAML's loader where it is available
+# (the path assumes this script has been moved to data/ before use, as described in extras/readme.txt)
+cfg = yaml.load(open(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'config.yml'), 'r'),
+                Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))['PREPROCESS']
 
 
 def video_to_frames_downsampled(orig_id, patient_id, df_rows, cap, fr, seq_length=cfg['PARAMS']['WINDOW'],
@@ -42,17 +46,25 @@ def video_to_frames_downsampled(orig_id, patient_id, df_rows, cap, fr, seq_lengt
     if cap_width == 0 or cap_height == 0:
         return
 
+    dsize = tuple(resize)  # Output size, as taken by cv2.resize
+    weights = np.array([0.2989, 0.5870, 0.1140])  # In accordance with tfa rgb to grayscale
+
     try:
         while True:
+            # Frames between every nth frame are only grabbed, skipping their colour conversion and copy-out
+            if index != 0:
+                if not cap.grab():
+                    break
+                index = (index + 1) % stride
+                continue
+
             ret, frame = cap.read()
             if not ret:
                 break
-            if index == 0:  # Add every nth frame only
-                frame = cv2.resize(frame, tuple(resize))
-                weights = [0.2989, 0.5870, 0.1140]  # In accordance with tfa rgb to grayscale
-                frame = np.dot(frame, weights).astype(np.uint8)
-                frame = np.expand_dims(frame, axis=-1)
-                frames.append(frame)
+            frame = cv2.resize(frame, dsize)
+            frame = np.dot(frame, weights).astype(np.uint8)
+            frame = np.expand_dims(frame, axis=-1)
+            frames.append(frame)
             index = (index + 1) % stride
 
     finally:
@@ -63,8 +75,8 @@ def video_to_frames_downsampled(orig_id, patient_id, df_rows, cap, fr, seq_lengt
     num_mini_clips = len(frames) // seq_length
     for i in range(num_mini_clips):
         df_rows.append([orig_id + '_' + str(counter), patient_id])
-        np.savez_compressed(write_path + '_' + str(counter), frames=frames[i * seq_length:i * seq_length + seq_length],
-                            bounding_box=box, height_width=(cap_height, cap_width))
+        np.savez(write_path + '_' + str(counter), frames=frames[i * seq_length:i * seq_length + seq_length],
+                 bounding_box=box, height_width=(cap_height, cap_width))
         counter += 1
 
     return
@@ -95,6 +107,9 @@ def video_to_frames_contig(orig_id, patient_id, df_rows, cap, seq_length=cfg['PA
     if cap_width == 0 or cap_height == 0:
         return
 
+    dsize = tuple(resize)  # Output size, as taken by cv2.resize
+    weights = np.array([0.2989, 0.5870, 0.1140])  # In accordance with tfa rgb to grayscale
+
     try:
         while True:
 
@@ -103,8 +118,8 @@ def video_to_frames_contig(orig_id, patient_id, df_rows, cap, seq_length=cfg['PA
             if counter == 0:
                 df_rows.append(
                     [orig_id + '_' + str(mini_clip_num), patient_id])  # append to what will make output dataframes
-                np.savez_compressed(write_path + '_' + str(mini_clip_num), frames=frames,
-                                    bounding_box=box, height_width=(cap_height, cap_width))  # output
+                np.savez(write_path + '_' + str(mini_clip_num), frames=frames,
+                         bounding_box=box, height_width=(cap_height, cap_width))  # output
                 counter = seq_length
                 mini_clip_num += 1
                 frames = []
@@ -113,9 +128,7 @@ def video_to_frames_contig(orig_id, patient_id, df_rows, cap, seq_length=cfg['PA
             if not ret:
                 break
 
-            frame = cv2.resize(frame, tuple(resize))
-
-            weights = [0.2989, 0.5870, 0.1140]  # In accordance with tfa rgb to grayscale
+            frame = cv2.resize(frame, dsize)
             frame = np.dot(frame, weights).astype(np.uint8)
             frame = np.expand_dims(frame, axis=-1)
 
@@ -150,24 +163,17 @@ def flow_frames_to_npz_downsampled(path, orig_id, patient_id, df_rows, fr, seq_l
 
     stride = fr // base_fr
 
-    # Read all flow frames
-    for file in os.listdir(path):
-
-        frame = cv2.imread(os.path.join(path, file), 0)
-        frame = cv2.resize(frame, tuple(resize))
-
-        # NOT TESTED
-        weights = [0.2989, 0.5870, 0.1140]  # In accordance with tfa rgb to grayscale
-        frame = np.dot(frame, weights).astype(np.uint8)
-        frame = np.expand_dims(frame, axis=-1)
+    # Index flow frames in order, keeping every nth flow frame only, before any are read
+    x_paths, y_paths = sorted_flow_frames(path, stride)
 
-        ind = int(file[7:12])  # flow frame number
+    dsize = tuple(resize)  # Output size, as taken by cv2.resize
 
-        if (ind - 1) % stride == 0:  # take every nth flow frame only
-            if '_x_' in file:
-                frames_x.append(frame)
-            else:
-                frames_y.append(frame)
+    # Read the kept flow frames
+    for frames, frame_paths in ((frames_x, x_paths), (frames_y, y_paths)):
+        for frame_path in frame_paths:
+            frame = cv2.imread(frame_path, 0)  # Flow frames are single-channel
+            frame = cv2.resize(frame, dsize)
+            frames.append(frame)
 
     counter = 1
     num_mini_clips = len(frames_x) // seq_length
@@ -177,7 +183,7 @@ def flow_frames_to_npz_downsampled(path, orig_id, patient_id, df_rows, fr, seq_l
         df_rows.append([orig_id + '_' + str(counter), patient_id])
         x_seq = np.array(frames_x[i * seq_length:i * seq_length + seq_length])
         y_seq = np.array(frames_y[i * seq_length:i * seq_length + seq_length])
-        np.savez_compressed(write_path + '_' + str(counter), frames=np.stack((x_seq, y_seq), axis=-1))
+        np.savez(write_path + '_' + str(counter), frames=np.stack((x_seq, y_seq), axis=-1))
         counter += 1
 
     return
@@ -200,21 +206,17 @@ def flow_frames_to_npz_contig(path, orig_id, patient_id, df_rows, seq_length=cfg
     frames_x = []
     frames_y = []
 
-    # Read all flow frames
-    for file in os.listdir(path):
+    # Index flow frames in order
+    x_paths, y_paths = sorted_flow_frames(path)
 
-        frame = cv2.imread(os.path.join(path, file), 0)
-        frame = cv2.resize(frame, tuple(resize))
+    dsize = tuple(resize)  # Output size, as taken by cv2.resize
 
-        # NOT TESTED
-        weights = [0.2989, 0.5870, 0.1140]  # In accordance with tfa rgb to grayscale
-        frame = np.dot(frame, weights).astype(np.uint8)
-        frame = np.expand_dims(frame, axis=-1)
-
-        if '_x_' in file:
-            frames_x.append(frame)
-        else:
-            frames_y.append(frame)
+    # Read all flow frames
+    for frames, frame_paths in ((frames_x, x_paths), (frames_y, y_paths)):
+        for frame_path in frame_paths:
+            frame = cv2.imread(frame_path, 0)  # Flow frames are single-channel
+            frame = cv2.resize(frame, dsize)
+            frames.append(frame)
 
     counter = 1
     num_mini_clips = len(frames_x) // seq_length
@@ -224,7 +226,7 @@ def flow_frames_to_npz_contig(path, orig_id, patient_id, df_rows, seq_length=cfg
         df_rows.append([orig_id + '_' + str(counter), patient_id])
         x_seq = np.array(frames_x[i * seq_length:i * seq_length + seq_length])
         y_seq = np.array(frames_y[i * seq_length:i * seq_length + seq_length])
-        np.savez_compressed(write_path + '_' + str(counter), frames=np.stack((x_seq, y_seq), axis=-1))
+        np.savez(write_path + '_' + str(counter), frames=np.stack((x_seq, y_seq), axis=-1))
         counter += 1
 
     return
@@ -302,34 +304,34 @@ if __name__ == '__main__':
     csv_out_folder = cfg['PATHS']['CSVS_OUTPUT']
 
     fps_df = pd.read_csv(os.path.join(csv_out_folder, 'extra_clip_frame_rates.csv'))
+    fps_map = dict(zip(fps_df['id'], fps_df['frame_rate']))  # Index frame rates by clip id once
 
     # Load object detection csv for m-mode
     box_df = pd.read_csv(os.path.join(csv_out_folder, 'extra_boxes.csv'))
 
     base_fr = cfg['PARAMS']['BASE_FR']
 
-    # Iterate through clips and extract & download mini-clips
+    # Build a conversion job per clip, each (conversion function, keyword arguments)
+
+    jobs = []
 
     if flow:
 
         for id in os.listdir(input_folder):
-            path = os.path.join(input_folder, id)
-            fr = ((fps_df[fps_df['id'] == id])['frame_rate']).values[0]
+            kwargs = dict(path=os.path.join(input_folder, id), orig_id=id, patient_id='N/A',
+                          write_path=(npz_folder + id))
+            fr = fps_map[id]
             fr = int(round(fr / base_fr) * base_fr)  # Cast to nearest multiple of base frame rate
             if fr == base_fr:
-                flow_frames_to_npz_contig(path, orig_id=id, patient_id='N/A', df_rows=df_rows,
-                                          write_path=(npz_folder + id))
+                jobs.append((flow_frames_to_npz_contig, kwargs))
             else:
-                flow_frames_to_npz_downsampled(path, orig_id=id, patient_id='N/A', df_rows=df_rows, fr=fr,
-                                               write_path=(npz_folder + id))
+                jobs.append((flow_frames_to_npz_downsampled, dict(kwargs, fr=fr)))
 
     else:
 
         for file in os.listdir(input_folder):
 
-            f = os.path.join(input_folder, file)
-
-            fr = ((fps_df[fps_df['id'] == file[:-4]])['frame_rate']).values[0]
+            fr = fps_map[file[:-4]]
             fr = int(round(fr / base_fr) * base_fr)  # Cast to nearest multiple of base frame rate
 
             query = box_df[box_df['id'] == file[:-4]]
@@ -338,8 +340,15 @@ if __name__ == '__main__':
                 box_info = query.iloc[0]
                 box = (box_info['ymin'], box_info['xmin'], box_info['ymax'], box_info['xmax'])
 
-                video_to_npz(f, orig_id=file[:-4], patient_id='N/A', df_rows=df_rows,
-                             write_path=(npz_folder + file[:-4]), fr=fr, box=box)
+                jobs.append((video_to_npz, dict(path=os.path.join(input_folder, file), orig_id=file[:-4],
+                                                patient_id='N/A', write_path=(npz_folder + file[:-4]), fr=fr,
+                                                box=box)))
+
+    # Extract & download mini-clips across processes, keeping rows in clip order
+    # OpenCV runs single-threaded in each worker, since parallelism already comes from the pool
+    with Pool(processes=os.cpu_count(), initializer=cv2.setNumThreads, initargs=(1,)) as pool:
+        for rows in pool.imap(collect_rows, jobs):
+            df_rows.extend(rows)
 
     # Download dataframes linking mini-clip ids and patient ids as csv files
     out_df = pd.DataFrame(df_rows, columns=['id', 'patient_id'])
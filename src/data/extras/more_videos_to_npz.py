@@ -6,8 +6,13 @@ import pandas as pd
 import os
 import yaml
 import argparse
+from multiprocessing import Pool
+from utils import sorted_flow_frames, letterbox_geometry, collect_rows
 
-cfg = yaml.full_load(open(os.path.join(os.getcwd(), "../../config.yml"), 'r'))['PREPROCESS']
+# Config is found relative to this file rather than the cwd, and parsed with LibYAML's loader where it is available
+# (the path assumes this script has been moved to data/ before use, as described in extras/readme.txt)
+cfg = yaml.load(open(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'config.yml'), 'r'),
+                Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))['PREPROCESS']
 
 
 def video_to_frames_downsampled(orig_id, patient_id, df_rows, cap, fr, seq_length=cfg['PARAMS']['WINDOW'],
@@ -32,51 +37,48 @@ def video_to_frames_downsampled(orig_id, patient_id, df_rows, cap, fr, seq_lengt
     assert (isinstance(fr, int))
     assert (fr % base_fr == 0)
 
-    frames = []
     stride = fr // base_fr
 
-    index = 0  # Position in 'frames' array where the next frame is to be appended
+    index = 0  # Counts frames read, so that only every nth frame is kept
+    k = 0  # Position in 'frames' array where the next frame is to be written
 
-    if crop:
+    cap_width = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
+    cap_height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
 
-        cap_width = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
-        cap_height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+    if cap_width == 0 or cap_height == 0:
+        return
 
-        if cap_width == 0 or cap_height == 0:
-            return
+    width, height = resize
 
-        new_width = None
-        new_height = None
+    # Region of the (padded) output frame that the resized frame is written to
+    if crop:
+        new_width, new_height, pad_top, pad_left = letterbox_geometry(cap_width, cap_height, width, height)
+    else:
+        new_width, new_height = width, height
+        pad_top, pad_left = 0, 0
 
-        if cap_width > cap_height:
-            new_width = tuple(resize)[0]
-            height_resize = int((cap_height / cap_width) * new_width)
-            pad_top = int((tuple(resize)[1] - height_resize) / 2)
-            pad_bottom = tuple(resize)[1] - height_resize - pad_top
-            pad_left, pad_right = 0, 0
-        else:
-            new_height = tuple(resize)[1]
-            width_resize = int((cap_width / cap_height) * new_height)
-            pad_left = int((tuple(resize)[0] - width_resize) / 2)
-            pad_right = tuple(resize)[0] - width_resize - pad_left
-            pad_top, pad_bottom = 0, 0
+    # Preallocate all kept frames - the zeroed buffer supplies the border padding
+    # (some containers report a negative frame count, so the estimate is clamped)
+    num_frames = max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), 0) // stride + 1
+    frames = np.zeros((num_frames, height, width, 3), dtype=np.uint8)
 
     try:
         while True:
+            # Frames between every nth frame are only grabbed, skipping their colour conversion and copy-out
+            if index != 0:
+                if not cap.grab():
+                    break
+                index = (index + 1) % stride
+                continue
+
             ret, frame = cap.read()
             if not ret:
                 break
-            if index == 0:  # Add every nth frame only
-                if crop:
-                    if new_width:
-                        frame = cv2.resize(frame, (new_width, height_resize))
-                    else:
-                        frame = cv2.resize(frame, (width_resize, new_height))
-                    frame = cv2.copyMakeBorder(frame, pad_top, pad_bottom, pad_left, pad_right, cv2.BORDER_CONSTANT,
-                                               value=[0, 0, 0])
-                else:
-                    frame = cv2.resize(frame, tuple(resize))
-                frames.append(frame)
+            if k == len(frames):  # Frame count reported by the container can be an underestimate
+                frames = np.concatenate((frames, np.zeros_like(frames)))
+            cv2.resize(frame, (new_width, new_height),
+                       dst=frames[k, pad_top:pad_top + new_height, pad_left:pad_left + new_width])
+            k += 1
             index = (index + 1) % stride
 
     finally:
@@ -84,7 +86,7 @@ def video_to_frames_downsampled(orig_id, patient_id, df_rows, cap, fr, seq_lengt
 
     # Assemble and save mini-clips from extracted frames
     counter = 1
-    num_mini_clips = len(frames) // seq_length
+    num_mini_clips = k // seq_length
     for i in range(num_mini_clips):
         df_rows.append([orig_id + '_' + str(counter), patient_id])
         np.savez(write_path + '_' + str(counter), frames=frames[i * seq_length:i * seq_length + seq_length])
@@ -110,31 +112,24 @@ def video_to_frames_contig(orig_id, patient_id, df_rows, cap, seq_length=cfg['PA
 
     counter = seq_length
     mini_clip_num = 1  # nth mini-clip being made from the main clip
-    frames = []
 
-    if crop:
+    cap_width = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
+    cap_height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
 
-        cap_width = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
-        cap_height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+    if cap_width == 0 or cap_height == 0:
+        return
 
-        if cap_width == 0 or cap_height == 0:
-            return
+    width, height = resize
 
-        new_width = None
-        new_height = None
+    # Region of the (padded) output frame that the resized frame is written to
+    if crop:
+        new_width, new_height, pad_top, pad_left = letterbox_geometry(cap_width, cap_height, width, height)
+    else:
+        new_width, new_height = width, height
+        pad_top, pad_left = 0, 0
 
-        if cap_width > cap_height:
-            new_width = tuple(resize)[0]
-            height_resize = int((cap_height / cap_width) * new_width)
-            pad_top = int((tuple(resize)[1] - height_resize) / 2)
-            pad_bottom = tuple(resize)[1] - height_resize - pad_top
-            pad_left, pad_right = 0, 0
-        else:
-            new_height = tuple(resize)[1]
-            width_resize = int((cap_width / cap_height) * new_height)
-            pad_left = int((tuple(resize)[0] - width_resize) / 2)
-            pad_right = tuple(resize)[0] - width_resize - pad_left
-            pad_top, pad_bottom = 0, 0
+    # Preallocated mini-clip buffer, reused for every mini-clip - the zeroed border supplies the padding
+    frames = np.zeros((seq_length, height, width, 3), dtype=np.uint8)
 
     try:
         while True:
@@ -147,23 +142,13 @@ def video_to_frames_contig(orig_id, patient_id, df_rows, cap, seq_length=cfg['PA
                 np.savez(write_path + '_' + str(mini_clip_num), frames=frames)  # output
                 counter = seq_length
                 mini_clip_num += 1
-                frames = []
 
             ret, frame = cap.read()
             if not ret:
                 break
 
-            if crop:
-                if new_width:
-                    frame = cv2.resize(frame, (new_width, height_resize))
-                else:
-                    frame = cv2.resize(frame, (width_resize, new_height))
-                frame = cv2.copyMakeBorder(frame, pad_top, pad_bottom, pad_left, pad_right, cv2.BORDER_CONSTANT,
-                                           value=[0, 0, 0])
-            else:
-                frame = cv2.resize(frame, tuple(resize))
-
-            frames.append(frame)
+            cv2.resize(frame, (new_width, new_height),
+                       dst=frames[seq_length - counter, pad_top:pad_top + new_height, pad_left:pad_left + new_width])
 
             counter -= 1
 
@@ -191,50 +176,34 @@ def flow_frames_to_npz_downsampled(path, orig_id, patient_id, df_rows, fr, seq_l
     :param base_fr: Base frame rate to downsample to
     '''
 
-    frames_x = []
-    frames_y = []
-
     stride = fr // base_fr
 
-    # Read all flow frames
-    for file in os.listdir(path):
-
-        frame = cv2.imread(os.path.join(path, file), 0)
-
-        if crop:
-
-            orig_width = frame.shape[1]  # height dimension should be first
-            orig_height = frame.shape[0]
-
-            if orig_width > orig_height:
-                new_width = tuple(resize)[0]
-                height_resize = int((orig_height / orig_width) * new_width)
-                pad_top = int((tuple(resize)[1] - height_resize) / 2)
-                pad_bottom = tuple(resize)[1] - height_resize - pad_top
-                pad_left, pad_right = 0, 0
-                frame = cv2.resize(frame, (new_width, height_resize))
-            else:
-                new_height = tuple(resize)[1]
-                width_resize = int((orig_width / orig_height) * new_height)
-                pad_left = int((tuple(resize)[0] - width_resize) / 2)
-                pad_right = tuple(resize)[0] - width_resize - pad_left
-                pad_top, pad_bottom = 0, 0
-                frame = cv2.resize(frame, (width_resize, new_height))
+    # Index flow frames in order, keeping every nth flow frame only, before any are read
+    x_paths, y_paths = sorted_flow_frames(path, stride)
 
-            frame = cv2.copyMakeBorder(frame, pad_top, pad_bottom, pad_left, pad_right, cv2.BORDER_CONSTANT,
-                                       value=[0, 0, 0])
+    if not x_paths:
+        return
 
-        else:
+    width, height = resize
 
-            frame = cv2.resize(frame, tuple(resize))
+    # Region of the (padded) output frame that each resized flow frame is written to
+    if crop:
+        orig_height, orig_width = cv2.imread(x_paths[0], 0).shape  # All flow frames of a clip share dimensions
+        new_width, new_height, pad_top, pad_left = letterbox_geometry(orig_width, orig_height, width, height)
+    else:
+        new_width, new_height = width, height
+        pad_top, pad_left = 0, 0
 
-        ind = int(file[7:12])  # flow frame number
+    # Preallocate flow frames - the zeroed buffers supply the border padding
+    frames_x = np.zeros((len(x_paths), height, width), dtype=np.uint8)
+    frames_y = np.zeros((len(y_paths), height, width), dtype=np.uint8)
 
-        if (ind - 1) % stride == 0:  # take every nth flow frame only
-            if '_x_' in file:
-                frames_x.append(frame)
-            else:
-                frames_y.append(frame)
+    # Read the flow frames
+    for frames, frame_paths in ((frames_x, x_paths), (frames_y, y_paths)):
+        for k, frame_path in enumerate(frame_paths):
+            frame = cv2.imread(frame_path, 0)
+            cv2.resize(frame, (new_width, new_height),
+                       dst=frames[k, pad_top:pad_top + new_height, pad_left:pad_left + new_width])
 
     counter = 1
     num_mini_clips = len(frames_x) // seq_length
@@ -242,8 +211,8 @@ def flow_frames_to_npz_downsampled(path, orig_id, patient_id, df_rows, fr, seq_l
     # Stack x and y flow (making 2 channels) and save mini-clip sequences
     for i in range(num_mini_clips):
         df_rows.append([orig_id + '_' + str(counter), patient_id])
-        x_seq = np.array(frames_x[i * seq_length:i * seq_length + seq_length])
-        y_seq = np.array(frames_y[i * seq_length:i * seq_length + seq_length])
+        x_seq = frames_x[i * seq_length:i * seq_length + seq_length]
+        y_seq = frames_y[i * seq_length:i * seq_length + seq_length]
         np.savez(write_path + '_' + str(counter), frames=np.stack((x_seq, y_seq), axis=-1))
         counter += 1
 
@@ -265,45 +234,32 @@ def flow_frames_to_npz_contig(path, orig_id, patient_id, df_rows, seq_length=cfg
     :param crop: Boolean, Whether inputs are cropped to pleural line or not
     '''
 
-    frames_x = []
-    frames_y = []
-
-    # Read all flow frames
-    for file in os.listdir(path):
-
-        frame = cv2.imread(os.path.join(path, file), 0)
-
-        if crop:
-
-            orig_width = frame.shape[1]  # height dimension should be first
-            orig_height = frame.shape[0]
+    # Index flow frames in order
+    x_paths, y_paths = sorted_flow_frames(path)
 
-            if orig_width > orig_height:
-                new_width = tuple(resize)[0]
-                height_resize = int((orig_height / orig_width) * new_width)
-                pad_top = int((tuple(resize)[1] - height_resize) / 2)
-                pad_bottom = tuple(resize)[1] - height_resize - pad_top
-                pad_left, pad_right = 0, 0
-                frame = cv2.resize(frame, (new_width, height_resize))
-            else:
-                new_height = tuple(resize)[1]
-                width_resize = int((orig_width / orig_height) * new_height)
-                pad_left = int((tuple(resize)[0] - width_resize) / 2)
-                pad_right = tuple(resize)[0] - width_resize - pad_left
-                pad_top, pad_bottom = 0, 0
-                frame = cv2.resize(frame, (width_resize, new_height))
+    if not x_paths:
+        return
 
-            frame = cv2.copyMakeBorder(frame, pad_top, pad_bottom, pad_left, pad_right, cv2.BORDER_CONSTANT,
-                                       value=[0, 0, 0])
+    width, height = resize
 
-        else:
+    # Region of the (padded) output frame that each resized flow frame is written to
+    if crop:
+        orig_height, orig_width = cv2.imread(x_paths[0], 0).shape  # All flow frames of a clip share dimensions
+        new_width, new_height, pad_top, pad_left = letterbox_geometry(orig_width, orig_height, width, height)
+    else:
+        new_width, new_height = width, height
+        pad_top, pad_left = 0, 0
 
-            frame = cv2.resize(frame, tuple(resize))
+    # Preallocate flow frames - the zeroed buffers supply the border padding
+    frames_x = np.zeros((len(x_paths), height, width), dtype=np.uint8)
+    frames_y = np.zeros((len(y_paths), height, width), dtype=np.uint8)
 
-        if '_x_' in file:
-            frames_x.append(frame)
-        else:
-            frames_y.append(frame)
+    # Read the flow frames
+    for frames, frame_paths in ((frames_x, x_paths), (frames_y, y_paths)):
+        for k, frame_path in enumerate(frame_paths):
+            frame = cv2.imread(frame_path, 0)
+            cv2.resize(frame, (new_width, new_height),
+                       dst=frames[k, pad_top:pad_top + new_height, pad_left:pad_left + new_width])
 
     counter = 1
     num_mini_clips = len(frames_x) // seq_length
@@ -311,8 +267,8 @@ def flow_frames_to_npz_contig(path, orig_id, patient_id, df_rows, seq_length=cfg
     # Stack x and y flow (making 2 channels) and save mini-clip sequences
     for i in range(num_mini_clips):
         df_rows.append([orig_id + '_' + str(counter), patient_id])
-        x_seq = np.array(frames_x[i * seq_length:i * seq_length + seq_length])
-        y_seq = np.array(frames_y[i * seq_length:i * seq_length + seq_length])
+        x_seq = frames_x[i * seq_length:i * seq_length + seq_length]
+        y_seq = frames_y[i * seq_length:i * seq_length + seq_length]
         np.savez(write_path + '_' + str(counter), frames=np.stack((x_seq, y_seq), axis=-1))
         counter += 1
 
@@ -404,30 +360,39 @@ if __name__ == '__main__':
 
     no_sliding_fps_df = pd.read_csv(os.path.join(csv_out_folder, 'no_sliding_frame_rates.csv'))
 
+    # Index patient ids and frame rates by clip id once, rather than masking the dataframes for every clip
+    no_sliding_patient_map = dict(zip(no_sliding_df['id'], no_sliding_df['patient_id']))
+    no_sliding_fps_map = dict(zip(no_sliding_fps_df['id'], no_sliding_fps_df['frame_rate']))
+
     base_fr = cfg['PARAMS']['BASE_FR']
 
-    # Iterate through clips and extract & download mini-clips
+    # Build a conversion job per clip, each (conversion function, keyword arguments)
+
+    jobs = []
 
     if flow:
 
         for id in os.listdir(no_sliding_input):
-            path = os.path.join(no_sliding_input, id)
-            patient_id = ((no_sliding_df[no_sliding_df['id'] == id])['patient_id']).values[0]
-            fr = ((no_sliding_fps_df[no_sliding_fps_df['id'] == id])['frame_rate']).values[0]
+            kwargs = dict(path=os.path.join(no_sliding_input, id), orig_id=id, patient_id=no_sliding_patient_map[id],
+                          write_path=(no_sliding_npz_folder + id), crop=crop)
+            fr = no_sliding_fps_map[id]
             if fr == base_fr:
-                flow_frames_to_npz_contig(path, orig_id=id, patient_id=patient_id, df_rows=df_rows_no_sliding,
-                                          write_path=(no_sliding_npz_folder + id), crop=crop)
+                jobs.append((flow_frames_to_npz_contig, kwargs))
             else:
-                flow_frames_to_npz_downsampled(path, orig_id=id, patient_id=patient_id, df_rows=df_rows_no_sliding,
-                                               fr=fr, write_path=(no_sliding_npz_folder + id), crop=crop)
+                jobs.append((flow_frames_to_npz_downsampled, dict(kwargs, fr=fr)))
 
     else:
 
         for file in os.listdir(no_sliding_input):
-            f = os.path.join(no_sliding_input, file)
-            patient_id = ((no_sliding_df[no_sliding_df['id'] == file[:-4]])['patient_id']).values[0]
-            video_to_npz(f, orig_id=file[:-4], patient_id=patient_id, df_rows=df_rows_no_sliding,
-                         write_path=(no_sliding_npz_folder + file[:-4]), crop=crop)
+            jobs.append((video_to_npz, dict(path=os.path.join(no_sliding_input, file), orig_id=file[:-4],
+                                            patient_id=no_sliding_patient_map[file[:-4]],
+                                            write_path=(no_sliding_npz_folder + file[:-4]), crop=crop)))
+
+    # Extract & download mini-clips across processes, keeping rows in clip order
+    # OpenCV runs single-threaded in each worker, since parallelism already comes from the pool
+    with Pool(processes=os.cpu_count(), initializer=cv2.setNumThreads, initargs=(1,)) as pool:
+        for rows in pool.imap(collect_rows, jobs):
+            df_rows_no_sliding.extend(rows)
 
     # Download dataframes linking mini-clip ids and patient ids as csv files
     out_df_no_sliding = pd.DataFrame(df_rows_no_sliding, columns=['id', 'patient_id'])
@@ -439,8 +404,6 @@ if __name__ == '__main__':
     else:
         csv_out_path_no_sliding = os.path.join(csv_out_folder, 'no_sliding_mini_clips.csv')
 
-    # Append to existing rows (for older clips that we already have)
-    orig_csv = pd.read_csv(csv_out_path_no_sliding)
-    out_df_no_sliding = pd.concat([orig_csv, out_df_no_sliding])
-
-    out_df_no_sliding.to_csv(csv_out_path_no_sliding, index=False)
+    # Append to existing rows (for older clips that we already have), without rewriting them
+    out_df_no_sliding.to_csv(csv_out_path_no_sliding, mode='a', header=not os.path.exists(csv_out_path_no_sliding),
+                             index=False)
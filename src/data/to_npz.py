@@ -4,12 +4,15 @@ import pandas as pd
 import os
 import yaml
 import argparse
-from utils import refresh_folder
+from multiprocessing import Pool
+from utils import refresh_folder, collect_rows
 from tqdm import tqdm
 from src.preprocessor import get_middle_pixel_index
 
-cfg = yaml.full_load(open(os.path.join(os.getcwd(), "../../config.yml"), 'r'))['PREPROCESS']
-cfg_full = yaml.full_load(open(os.path.join(os.getcwd(), "../../config.yml"), 'r'))
+# Config is found relative to this file rather than the cwd, and parsed with LibYAML's loader where it is available
+cfg_full = yaml.load(open(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'config.yml'), 'r'),
+                     Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+cfg = cfg_full['PREPROCESS']
 
 # PIPELINE UPDATE FOR BOX AND ORIG DIMS NOT APPLIED FOR FLOW!!!
 
@@ -48,17 +51,25 @@ def video_to_frames_downsampled(orig_id, patient_id, df_rows, cap, fr, seq_lengt
     if cap_width == 0 or cap_height == 0:
         return
 
+    dsize = tuple(reversed(resize))  # Output size, as taken by cv2.resize
+    weights = np.array([0.2989, 0.5870, 0.1140])  # In accordance with tfa rgb to grayscale
+
     try:
         while True:
+            # Frames between every nth frame are only grabbed, skipping their colour conversion and copy-out
+            if index != 0:
+                if not cap.grab():
+                    break
+                index = (index + 1) % stride
+                continue
+
             ret, frame = cap.read()
             if not ret:
                 break
-            if index == 0:  # Add every nth frame only
-                frame = cv2.resize(frame, tuple(reversed(resize)))
-                weights = [0.2989, 0.5870, 0.1140]  # In accordance with tfa rgb to grayscale
-                frame = np.dot(frame, weights).astype(np.uint8)
-                frame = np.expand_dims(frame, axis=-1)
-                frames.append(frame)
+            frame = cv2.resize(frame, dsize)
+            frame = np.dot(frame, weights).astype(np.uint8)
+            frame = np.expand_dims(frame, axis=-1)
+            frames.append(frame)
             index = (index + 1) % stride
 
     finally:
@@ -128,6 +139,9 @@ def video_to_frames_contig(orig_id, patient_id, df_rows, cap, seq_length=cfg['PA
     if cap_width == 0 or cap_height == 0:
         return
 
+    dsize = tuple(reversed(resize))  # Output size, as taken by cv2.resize
+    weights = np.array([0.2989, 0.5870, 0.1140])  # In accordance with tfa rgb to grayscale
+
     try:
         while True:
 
@@ -146,9 +160,7 @@ def video_to_frames_contig(orig_id, patient_id, df_rows, cap, seq_length=cfg['PA
             if not ret:
                 break
 
-            frame = cv2.resize(frame, tuple(reversed(resize)))
-
-            weights = [0.2989, 0.5870, 0.1140]  # In accordance with tfa rgb to grayscale
+            frame = cv2.resize(frame, dsize)
             frame = np.dot(frame, weights).astype(np.uint8)
             frame = np.expand_dims(frame, axis=-1)
 
@@ -229,6 +241,10 @@ if __name__ == '__main__':
     sliding_fps_df = pd.read_csv(os.path.join(csv_out_folder, 'sliding_frame_rates.csv'))
     no_sliding_fps_df = pd.read_csv(os.path.join(csv_out_folder, 'no_sliding_frame_rates.csv'))
 
+    # Index patient ids by clip id once, rather than masking the dataframes for every clip
+    sliding_patient_map = dict(zip(sliding_df['id'], sliding_df['patient_id']))
+    no_sliding_patient_map = dict(zip(no_sliding_df['id'], no_sliding_df['patient_id']))
+
     # Load object detection csv for m-mode
     use_box = cfg['PARAMS']['USE_BOUNDING_BOX']
     if use_box:
@@ -237,12 +253,13 @@ if __name__ == '__main__':
 
     base_fr = cfg['PARAMS']['BASE_FR']
 
-    # Iterate through clips and extract & download mini-clips
+    # Build a conversion job per clip, each (conversion function, keyword arguments)
 
-    for file in tqdm(os.listdir(sliding_input)):
+    sliding_jobs = []
+    for file in os.listdir(sliding_input):
 
-        f = os.path.join(sliding_input, file)
-        patient_id = ((sliding_df[sliding_df['id'] == file[:-4]])['patient_id']).values[0]
+        kwargs = dict(path=os.path.join(sliding_input, file), orig_id=file[:-4],
+                      patient_id=sliding_patient_map[file[:-4]], write_path=(sliding_npz_folder + file[:-4]))
 
         if use_box:
             query = sliding_box_df[sliding_box_df['id'] == file[:-4]]
@@ -251,16 +268,15 @@ if __name__ == '__main__':
                 box_info = query.iloc[0]
                 box = (box_info['ymin'], box_info['xmin'], box_info['ymax'], box_info['xmax'])
 
-                video_to_npz(f, orig_id=file[:-4], patient_id=patient_id, df_rows=df_rows_sliding,
-                             write_path=(sliding_npz_folder + file[:-4]), box=box)
+                sliding_jobs.append((video_to_npz, dict(kwargs, box=box)))
         else:
-            video_to_npz(f, orig_id=file[:-4], patient_id=patient_id, df_rows=df_rows_sliding,
-                         write_path=(sliding_npz_folder + file[:-4]))
+            sliding_jobs.append((video_to_npz, kwargs))
 
-    for file in tqdm(os.listdir(no_sliding_input)):
+    no_sliding_jobs = []
+    for file in os.listdir(no_sliding_input):
 
-        f = os.path.join(no_sliding_input, file)
-        patient_id = ((no_sliding_df[no_sliding_df['id'] == file[:-4]])['patient_id']).values[0]
+        kwargs = dict(path=os.path.join(no_sliding_input, file), orig_id=file[:-4],
+                      patient_id=no_sliding_patient_map[file[:-4]], write_path=(no_sliding_npz_folder + file[:-4]))
 
         if use_box:
             query = no_sliding_box_df[no_sliding_box_df['id'] == file[:-4]]
@@ -269,11 +285,19 @@ if __name__ == '__main__':
                 box_info = query.iloc[0]
                 box = (box_info['ymin'], box_info['xmin'], box_info['ymax'], box_info['xmax'])
 
-                video_to_npz(f, orig_id=file[:-4], patient_id=patient_id, df_rows=df_rows_no_sliding,
-                             write_path=(no_sliding_npz_folder + file[:-4]), box=box)
+                no_sliding_jobs.append((video_to_npz, dict(kwargs, box=box)))
         else:
-            video_to_npz(f, orig_id=file[:-4], patient_id=patient_id, df_rows=df_rows_no_sliding,
-                         write_path=(no_sliding_npz_folder + file[:-4]))
+            no_sliding_jobs.append((video_to_npz, kwargs))
+
+    # Extract & download mini-clips across processes - both classes are queued up front, rows are kept in clip order
+    # OpenCV runs single-threaded in each worker, since parallelism already comes from the pool
+    with Pool(processes=os.cpu_count(), initializer=cv2.setNumThreads, initargs=(1,)) as pool:
+        sliding_results = pool.imap(collect_rows, sliding_jobs)
+        no_sliding_results = pool.imap(collect_rows, no_sliding_jobs)
+        for rows in tqdm(sliding_results, total=len(sliding_jobs)):
+            df_rows_sliding.extend(rows)
+        for rows in tqdm(no_sliding_results, total=len(no_sliding_jobs)):
+            df_rows_no_sliding.extend(rows)
 
     # Download dataframes linking mini-clip ids and patient ids as csv files
     out_df_sliding = pd.DataFrame(df_rows_sliding, columns=['id', 'patient_id'])
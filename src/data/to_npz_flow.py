@@ -4,10 +4,13 @@ import pandas as pd
 import os
 import yaml
 import argparse
-from utils import refresh_folder
+from multiprocessing import Pool
+from utils import refresh_folder, sorted_flow_frames, collect_rows
 from tqdm import tqdm
 
-cfg = yaml.full_load(open(os.path.join(os.getcwd(), "../../config.yml"), 'r'))['PREPROCESS']
+# Config is found relative to this file rather than the cwd, and parsed with LibYAML's loader where it is available
+cfg = yaml.load(open(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'config.yml'), 'r'),
+                Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))['PREPROCESS']
 
 
 def flow_frames_to_npz_downsampled(path, orig_id, patient_id, df_rows, fr, seq_length=cfg['PARAMS']['M_MODE_WIDTH'],
@@ -32,24 +35,17 @@ def flow_frames_to_npz_downsampled(path, orig_id, patient_id, df_rows, fr, seq_l
 
     stride = fr // base_fr
 
-    # Read all flow frames
-    for file in os.listdir(path):
-
-        frame = cv2.imread(os.path.join(path, file), 0)
-        frame = cv2.resize(frame, tuple(reversed(resize)))
+    # Index flow frames in order, keeping every nth flow frame only, before any are read
+    x_paths, y_paths = sorted_flow_frames(path, stride)
 
-        # NOT TESTED
-        weights = [0.2989, 0.5870, 0.1140]  # In accordance with tfa rgb to grayscale
-        frame = np.dot(frame, weights).astype(np.uint8)
-        frame = np.expand_dims(frame, axis=-1)
+    dsize = tuple(reversed(resize))  # Output size, as taken by cv2.resize
 
-        ind = int(file[7:12])  # flow frame number
-
-        if (ind - 1) % stride == 0:  # take every nth flow frame only
-            if '_x_' in file:
-                frames_x.append(frame)
-            else:
-                frames_y.append(frame)
+    # Read the kept flow frames
+    for frames, frame_paths in ((frames_x, x_paths), (frames_y, y_paths)):
+        for frame_path in frame_paths:
+            frame = cv2.imread(frame_path, 0)  # Flow frames are single-channel
+            frame = cv2.resize(frame, dsize)
+            frames.append(frame)
 
     counter = 1
     num_mini_clips = len(frames_x) // seq_length
@@ -59,7 +55,7 @@ def flow_frames_to_npz_downsampled(path, orig_id, patient_id, df_rows, fr, seq_l
         df_rows.append([orig_id + '_' + str(counter), patient_id])
         x_seq = np.array(frames_x[i * seq_length:i * seq_length + seq_length])
         y_seq = np.array(frames_y[i * seq_length:i * seq_length + seq_length])
-        np.savez_compressed(write_path + '_' + str(counter), frames=np.stack((x_seq, y_seq), axis=-1))
+        np.savez(write_path + '_' + str(counter), frames=np.stack((x_seq, y_seq), axis=-1))
         counter += 1
 
     return
@@ -83,21 +79,17 @@ def flow_frames_to_npz_contig(path, orig_id, patient_id, df_rows, seq_length=cfg
     frames_x = []
     frames_y = []
 
-    # Read all flow frames
-    for file in os.listdir(path):
-
-        frame = cv2.imread(os.path.join(path, file), 0)
-        frame = cv2.resize(frame, tuple(reversed(resize)))
+    # Index flow frames in order
+    x_paths, y_paths = sorted_flow_frames(path)
 
-        # NOT TESTED
-        weights = [0.2989, 0.5870, 0.1140]  # In accordance with tfa rgb to grayscale
-        frame = np.dot(frame, weights).astype(np.uint8)
-        frame = np.expand_dims(frame, axis=-1)
+    dsize = tuple(reversed(resize))  # Output size, as taken by cv2.resize
 
-        if '_x_' in file:
-            frames_x.append(frame)
-        else:
-            frames_y.append(frame)
+    # Read all flow frames
+    for frames, frame_paths in ((frames_x, x_paths), (frames_y, y_paths)):
+        for frame_path in frame_paths:
+            frame = cv2.imread(frame_path, 0)  # Flow frames are single-channel
+            frame = cv2.resize(frame, dsize)
+            frames.append(frame)
 
     counter = 1
     num_mini_clips = len(frames_x) // seq_length
@@ -107,7 +99,7 @@ def flow_frames_to_npz_contig(path, orig_id, patient_id, df_rows, seq_length=cfg
         df_rows.append([orig_id + '_' + str(counter), patient_id])
         x_seq = np.array(frames_x[i * seq_length:i * seq_length + seq_length])
         y_seq = np.array(frames_y[i * seq_length:i * seq_length + seq_length])
-        np.savez_compressed(write_path + '_' + str(counter), frames=np.stack((x_seq, y_seq), axis=-1))
+        np.savez(write_path + '_' + str(counter), frames=np.stack((x_seq, y_seq), axis=-1))
         counter += 1
 
     return
@@ -144,6 +136,12 @@ if __name__ == '__main__':
     sliding_fps_df = pd.read_csv(os.path.join(csv_out_folder, 'sliding_frame_rates.csv'))
     no_sliding_fps_df = pd.read_csv(os.path.join(csv_out_folder, 'no_sliding_frame_rates.csv'))
 
+    # Index patient ids and frame rates by clip id once, rather than masking the dataframes for every clip
+    sliding_patient_map = dict(zip(sliding_df['id'], sliding_df['patient_id']))
+    no_sliding_patient_map = dict(zip(no_sliding_df['id'], no_sliding_df['patient_id']))
+    sliding_fps_map = dict(zip(sliding_fps_df['id'], sliding_fps_df['frame_rate']))
+    no_sliding_fps_map = dict(zip(no_sliding_fps_df['id'], no_sliding_fps_df['frame_rate']))
+
     # Load object detection csv for m-mode
     use_box = cfg['PARAMS']['USE_BOUNDING_BOX']
     if use_box:
@@ -152,29 +150,37 @@ if __name__ == '__main__':
 
     base_fr = cfg['PARAMS']['BASE_FR']
 
-    # Iterate through clips and extract & download mini-clips
+    # Build a conversion job per clip, each (conversion function, keyword arguments)
 
-    for id in tqdm(os.listdir(sliding_input)):
-        path = os.path.join(sliding_input, id)
-        patient_id = ((sliding_df[sliding_df['id'] == id])['patient_id']).values[0]
-        fr = ((sliding_fps_df[sliding_fps_df['id'] == id])['frame_rate']).values[0]
+    sliding_jobs = []
+    for id in os.listdir(sliding_input):
+        kwargs = dict(path=os.path.join(sliding_input, id), orig_id=id, patient_id=sliding_patient_map[id],
+                      write_path=(sliding_npz_folder + id))
+        fr = sliding_fps_map[id]
         if fr == base_fr:
-            flow_frames_to_npz_contig(path, orig_id=id, patient_id=patient_id, df_rows=df_rows_sliding,
-                                      write_path=(sliding_npz_folder + id))
+            sliding_jobs.append((flow_frames_to_npz_contig, kwargs))
         else:
-            flow_frames_to_npz_downsampled(path, orig_id=id, patient_id=patient_id, df_rows=df_rows_sliding, fr=fr,
-                                           write_path=(sliding_npz_folder + id))
+            sliding_jobs.append((flow_frames_to_npz_downsampled, dict(kwargs, fr=fr)))
 
-    for id in tqdm(os.listdir(no_sliding_input)):
-        path = os.path.join(no_sliding_input, id)
-        patient_id = ((no_sliding_df[no_sliding_df['id'] == id])['patient_id']).values[0]
-        fr = ((no_sliding_fps_df[no_sliding_fps_df['id'] == id])['frame_rate']).values[0]
+    no_sliding_jobs = []
+    for id in os.listdir(no_sliding_input):
+        kwargs = dict(path=os.path.join(no_sliding_input, id), orig_id=id, patient_id=no_sliding_patient_map[id],
+                      write_path=(no_sliding_npz_folder + id))
+        fr = no_sliding_fps_map[id]
         if fr == base_fr:
-            flow_frames_to_npz_contig(path, orig_id=id, patient_id=patient_id, df_rows=df_rows_no_sliding,
-                                      write_path=(no_sliding_npz_folder + id))
+            no_sliding_jobs.append((flow_frames_to_npz_contig, kwargs))
         else:
-            flow_frames_to_npz_downsampled(path, orig_id=id, patient_id=patient_id, df_rows=df_rows_no_sliding,
-                                           fr=fr, write_path=(no_sliding_npz_folder + id))
+            no_sliding_jobs.append((flow_frames_to_npz_downsampled, dict(kwargs, fr=fr)))
+
+    # Extract & download mini-clips across processes - both classes are queued up front, rows are kept in clip order
+    # OpenCV runs single-threaded in each worker, since parallelism already comes from the pool
+    with Pool(processes=os.cpu_count(), initializer=cv2.setNumThreads, initargs=(1,)) as pool:
+        sliding_results = pool.imap(collect_rows, sliding_jobs)
+        no_sliding_results = pool.imap(collect_rows, no_sliding_jobs)
+        for rows in tqdm(sliding_results, total=len(sliding_jobs)):
+            df_rows_sliding.extend(rows)
+        for rows in tqdm(no_sliding_results, total=len(no_sliding_jobs)):
+            df_rows_no_sliding.extend(rows)
 
     # Download dataframes linking mini-clip ids and patient ids as csv files
     out_df_sliding = pd.DataFrame(df_rows_sliding, columns=['id', 'patient_id'])
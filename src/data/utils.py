@@ -1,6 +1,12 @@
 import os
+import re
+import subprocess
+from functools import lru_cache
 from shutil import rmtree
 
+# Axis (x or y) and frame number of an optical flow frame, e.g. flow_x_00001.jpg
+FLOW_FRAME_PATTERN = re.compile(r'_([xy])_(\d{5})')
+
 
 def refresh_folder(path):
     '''
@@ -11,4 +17,74 @@ def refresh_folder(path):
         os.makedirs(path)
     else:
         rmtree(path)
-        os.makedirs(path)
\ No newline at end of file
+        os.makedirs(path)
+
+
+def probe_fps(path):
+    '''
+    Reads the frame rate of a video from its container metadata with ffprobe, without initializing a decoder
+    :param path: Path to the video file
+    :return: Frame rate of the video, rounded to the nearest integer (0 if it cannot be determined)
+    '''
+    out = subprocess.run(['ffprobe', '-v', '0', '-select_streams', 'v:0', '-show_entries',
+                          'stream=avg_frame_rate', '-of', 'csv=p=0', path], stdout=subprocess.PIPE).stdout
+
+    # ffprobe fails or prints nothing for corrupt or non-video files, and for files without a video stream
+    match = re.fullmatch(rb'(\d+)/(\d+)', out.strip())
+    if match is None or int(match.group(2)) == 0:
+        return 0
+    return round(int(match.group(1)) / int(match.group(2)))
+
+
+def sorted_flow_frames(path, stride=1):
+    '''
+    Indexes a directory of optical flow frames (flow_x_#####.jpg and flow_y_#####.jpg) in a single scan
+    :param path: Path to directory containing flow frames
+    :param stride: Only every nth flow frame, starting from the first, is kept
+    :return: Tuple of (x flow frame paths, y flow frame paths), each sorted by flow frame number
+    '''
+    frames = {'x': [], 'y': []}  # (flow frame number, path) for each axis
+    for entry in os.scandir(path):
+        match = FLOW_FRAME_PATTERN.search(entry.name)
+        if match:
+            ind = int(match.group(2))
+            if (ind - 1) % stride == 0:
+                frames[match.group(1)].append((ind, entry.path))
+    x_paths = [frame_path for _, frame_path in sorted(frames['x'])]
+    y_paths = [frame_path for _, frame_path in sorted(frames['y'])]
+    return x_paths, y_paths
+
+
+def collect_rows(job):
+    '''
+    Runs the npz conversion of a single clip (e.g. in a worker process) and returns the rows it produced
+    :param job: Tuple of (conversion function, dict of its keyword arguments other than df_rows)
+    :return: list of (mini-clip_ID, patient_ID) for the mini-clips made from the clip
+    '''
+    convert, kwargs = job
+    df_rows = []
+    convert(df_rows=df_rows, **kwargs)
+    return df_rows
+
+
+@lru_cache(maxsize=16)
+def letterbox_geometry(orig_width, orig_height, width, height):
+    '''
+    Computes where a frame is placed when it is resized, preserving aspect ratio, and padded to the output size
+    :param orig_width: Width of the original frame
+    :param orig_height: Height of the original frame
+    :param width: Width of the (padded) output frame
+    :param height: Height of the (padded) output frame
+    :return: Tuple of (new_width, new_height, pad_top, pad_left) of the resized frame within the output frame
+    '''
+    if orig_width > orig_height:
+        new_width = width
+        new_height = int((orig_height / orig_width) * new_width)
+        pad_top = int((height - new_height) / 2)
+        pad_left = 0
+    else:
+        new_height = height
+        new_width = int((orig_width / orig_height) * new_height)
+        pad_left = int((width - new_width) / 2)
+        pad_top = 0
+    return new_width, new_height, pad_top, pad_left
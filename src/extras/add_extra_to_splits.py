@@ -23,11 +23,7 @@ def df_splits_two_stream(df, flow_df, train, val, test, random_state=cfg['TRAIN'
     '''
 
     # Keep only mini-clips existing for regular frames and flow frames in df
-    drop_indices = []
-    for index, row in df.iterrows():
-        if not (row['id'] in list(flow_df['id'])):
-            drop_indices.append(index)
-    df = df.drop(drop_indices)
+    df = df.drop(df.index[~df['id'].isin(flow_df['id'])])
 
     # Make splits from remaining mini-clips
     df = df_splits(df, train, val, test, random_state)
@@ -63,18 +59,10 @@ def df_splits(df, train, val, test, random_state=cfg['TRAIN']['SPLITS']['RANDOM_
         splits[1] = val_test_splits[0]
         splits.append(val_test_splits[1])
 
-    # Add split labels to dataframe
-    split_labels = []
-    for index, row in df.iterrows():
-        curr_id = row['id']
-        if curr_id in splits[1]:
-            split_labels.append(1)
-        elif curr_id in splits[2]:
-            split_labels.append(2)
-        else:
-            split_labels.append(0)
-
-    df['split'] = split_labels
+    # Add split labels to dataframe, looking each id up in a single map rather than scanning the splits per row
+    split_of_id = dict.fromkeys(splits[2], 2)
+    split_of_id.update(dict.fromkeys(splits[1], 1))
+    df['split'] = [split_of_id.get(curr_id, 0) for curr_id in df['id']]
 
     return df
 
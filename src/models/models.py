@@ -10,6 +10,7 @@ import tempfile
 import tensorflow as tf
 import numpy as np
 import math
+from functools import lru_cache
 
 from tensorflow.keras.layers import Dense, Flatten, Lambda, Reshape, Conv1D
 from tensorflow.keras.layers import LSTM
@@ -32,59 +33,24 @@ from tensorflow.keras.applications.efficientnet import EfficientNetB0 as Efficie
 from tensorflow.keras.applications.efficientnet import preprocess_input as efficientnet_preprocess
 import tensorflow_addons as tfa
 
-cfg = yaml.full_load(open(os.path.join(os.getcwd(), '../config.yml'), 'r'))
+cfg = yaml.load(open(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'config.yml'), 'r'),
+                Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 
 
 def get_model(model_name):
     '''
     Gets the function that returns the desired model function and its associated preprocessing function.
 
-    :param model_name: A string in the list below specifying the model
+    :param model_name: A string in MODELS (at the bottom of this file) specifying the model
 
     :return: A Tuple (Function returning compiled model, Required preprocessing function)
     '''
 
     flow = True if cfg['PREPROCESS']['PARAMS']['FLOW'] == 'Yes' else False
 
-    if model_name == 'lrcn':
-        model_def_fn = lrcn
-        preprocessing_fn = normalize
-    elif model_name == 'threeDCNN':
-        model_def_fn = threeDCNN
-        preprocessing_fn = normalize
-    elif model_name == 'xception_raw':
-        model_def_fn = xception_raw
-        preprocessing_fn = xception_preprocess
-    elif model_name == 'vgg16':
-        model_def_fn = vgg16
-        preprocessing_fn = vgg16_preprocess
-    elif model_name == 'res3d':
-        model_def_fn = res3d
-        preprocessing_fn = normalize
-    elif model_name == 'inflated_resnet50':
-        model_def_fn = inflated_resnet50
-        preprocessing_fn = resnet_preprocess
-    elif model_name == 'i3d':
-        model_def_fn = i3d
-        preprocessing_fn = [normalize, normalize]
-    elif model_name == 'xception':
-        model_def_fn = xception
-        preprocessing_fn = xception_preprocess
-    elif model_name == 'vit':
-        model_def_fn = vit
-        preprocessing_fn = normalize
-    elif model_name == 'variance_mmode_net':
-        model_def_fn = variance_mmode_net
-        preprocessing_fn = normalize
-    elif model_name == 'one_d_conv':
-        model_def_fn = one_d_conv
-        preprocessing_fn = normalize
-    elif model_name == 'mobilenet_v3_small':
-        model_def_fn = mobile_net_v3_small
-        preprocessing_fn = mobilenet_v3_preprocess
-    elif model_name == 'efficientnet':
-        model_def_fn = efficientnet
-        preprocessing_fn = efficientnet_preprocess
+    if model_name not in MODELS:
+        raise KeyError('Unknown model \'{}\'. Choose from: {}'.format(model_name, ', '.join(MODELS)))
+    model_def_fn, preprocessing_fn = MODELS[model_name]
 
     if flow:
         preprocessing_fn = normalize
@@ -102,6 +68,18 @@ def normalize(x):
     return x / 255.0
 
 
+def output_bias_initializer(class_counts):
+    '''
+    Gets the initializer for the output head's bias, set to the log ratio of the class counts if OUTPUT_BIAS is enabled
+
+    :param class_counts: 2-element list - number of each class in training set
+    :return: Constant initializer, or None for the default initializer
+    '''
+    if not cfg['TRAIN']['OUTPUT_BIAS']:
+        return None
+    return tf.keras.initializers.Constant(math.log(class_counts[1] / class_counts[0]))
+
+
 def xception_raw(model_config, input_shape, metrics, class_counts):
     '''
     Time-distributed raw (not pre-trained) Xception feature extractor with LSTM and output head on top
@@ -122,67 +100,19 @@ def xception_raw(model_config, input_shape, metrics, class_counts):
 
     x_input = Input(input_shape, name='input')
 
-    # First block
-    x = TimeDistributed(base.layers[1], name=base.layers[1].name)(x_input)
-    for i in range(2, 7):
-        x = TimeDistributed(base.layers[i], name=base.layers[i].name)(x)
-    prev_add = x
-
-    # Second block
-    for i in range(7, 12):
-        x = TimeDistributed(base.layers[i], name=base.layers[i].name)(x)
-    x = TimeDistributed(base.layers[13], name=base.layers[13].name)(x)  # batch norm
-    x = TimeDistributed(base.layers[14], name=base.layers[14].name)(x)  # max pooling
-    skip = TimeDistributed(base.layers[12], name=base.layers[12].name)(prev_add)  # Conv2d residual branch
-    x = TimeDistributed(Add(), name=base.layers[15].name)([x, skip])
-    prev_add = x
-
-    # Third block
-    for i in range(16, 22):
-        x = TimeDistributed(base.layers[i], name=base.layers[i].name)(x)
-    x = TimeDistributed(base.layers[23], name=base.layers[23].name)(x)
-    x = TimeDistributed(base.layers[24], name=base.layers[24].name)(x)
-    skip = TimeDistributed(base.layers[22], name=base.layers[22].name)(prev_add)  # Conv2d residual branch
-    x = TimeDistributed(Add(), name=base.layers[25].name)([x, skip])
-    prev_add = x
-
-    # Fourth block
-    for i in range(26, 32):
-        x = TimeDistributed(base.layers[i], name=base.layers[i].name)(x)
-    x = TimeDistributed(base.layers[33], name=base.layers[33].name)(x)
-    x = TimeDistributed(base.layers[34], name=base.layers[34].name)(x)
-    skip = TimeDistributed(base.layers[32], name=base.layers[32].name)(prev_add)  # Conv2d residual branch
-    x = TimeDistributed(Add(), name=base.layers[35].name)([x, skip])
-    prev_add = x
-
-    # Blocks 5 through 12
-    for n in range(0, 71, 10):
-        for i in range(36 + n, 45 + n):
-            x = TimeDistributed(base.layers[i], name=base.layers[i].name)(x)
-        x = TimeDistributed(Add(), name=base.layers[45 + n].name)([x, prev_add])
-        prev_add = x
-
-    # Block 13
-    for i in range(116, 122):
-        x = TimeDistributed(base.layers[i], name=base.layers[i].name)(x)
-    x = TimeDistributed(base.layers[123], name=base.layers[123].name)(x)
-    x = TimeDistributed(base.layers[124], name=base.layers[124].name)(x)
-    skip = TimeDistributed(base.layers[122], name=base.layers[122].name)(prev_add)  # Conv2d residual branch
-    x = TimeDistributed(Add(), name=base.layers[125].name)([x, skip])
-
-    # Block 14
-    for layer in base.layers[126:]:
-        x = TimeDistributed(layer, name=layer.name)(x)
+    # Apply the whole Xception base to every frame at once, with time folded into the batch dimension
+    x = TimeDistributed(base, name=base.name)(x_input)
 
     # LSTM and output head
     x = LSTM(256, return_sequences=False, dropout=dropout)(x)
     x = Dense(128, activation='relu')(x)
-    outputs = Dense(1, activation='sigmoid')(x)
+    outputs = Dense(1, activation='sigmoid', dtype='float32')(x)
 
     model = tf.keras.Model(inputs=x_input, outputs=outputs)
-    model.summary()
+    if cfg['TRAIN']['MODEL_SUMMARY']:
+        model.summary()
 
-    model.compile(loss='binary_crossentropy', optimizer=optimizer, metrics=metrics)
+    model.compile(loss='binary_crossentropy', optimizer=optimizer, metrics=metrics, jit_compile=cfg['TRAIN']['XLA'])
 
     return model
 
@@ -207,12 +137,7 @@ def vgg16(model_config, input_shape, metrics, class_counts):
     dropout = model_config['DROPOUT']
     l2_reg = model_config['L2_REG']  # NOT USED RN
 
-    output_bias = None
-    if cfg['TRAIN']['OUTPUT_BIAS']:
-        count0 = class_counts[0]
-        count1 = class_counts[1]
-        output_bias = math.log(count1 / count0)
-        output_bias = tf.keras.initializers.Constant(output_bias)
+    output_bias = output_bias_initializer(class_counts)
 
     kernel_init = model_config['WEIGHT_INITIALIZER']  # NOT USED IN CONV LAYERS RN
 
@@ -228,25 +153,27 @@ def vgg16(model_config, input_shape, metrics, class_counts):
 
     model.add(InputLayer(input_shape=input_shape))
 
+    # Per-frame feature extractor, applied to all frames at once with time folded into the batch dimension
     stop_block = model_config['BLOCKS'] + 1
-    for layer in base.layers[1:-1]:
-        if int(layer.name[5:6]) < stop_block:  # only add blocks up to specified 'last block'
-            model.add(TimeDistributed(layer, name=layer.name))
+    # only add blocks up to specified 'last block'
+    frame_layers = [layer for layer in base.layers[1:-1] if int(layer.name[5:6]) < stop_block]
+    frame_cnn = Sequential([InputLayer(input_shape=input_shape[1:])] + frame_layers + [base.layers[-1]],  # GAP
+                           name=base.name)
 
-    model.add(TimeDistributed(base.layers[-1], name=base.layers[-1].name))  # GAP
+    model.add(TimeDistributed(frame_cnn, name=frame_cnn.name))
     model.add(LSTM(256, return_sequences=False))
     model.add(Dropout(dropout))
     model.add(Dense(1, activation='sigmoid', kernel_initializer=kernel_init, bias_initializer=output_bias,
                     dtype='float32'))
 
-    model.summary()
+    if cfg['TRAIN']['MODEL_SUMMARY']:
+        model.summary()
 
-    # Freeze layers
-    for i in range(len(model.layers)):
-        if i < model_config['LAST_FROZEN']:
-            model.layers[i].trainable = False
+    # Freeze layers, counting each VGG16 layer of the frame extractor individually
+    for layer in (frame_cnn.layers + model.layers[1:])[:model_config['LAST_FROZEN']]:
+        layer.trainable = False
 
-    model.compile(loss='binary_crossentropy', optimizer=optimizer, metrics=metrics)
+    model.compile(loss='binary_crossentropy', optimizer=optimizer, metrics=metrics, jit_compile=cfg['TRAIN']['XLA'])
 
     return model
 
@@ -264,50 +191,53 @@ def lrcn(model_config, input_shape, metrics, class_counts):
 
     def add_default_block(model, kernel_filters, init, reg_lambda):
         # conv
-        model.add(TimeDistributed(Conv2D(kernel_filters, (3, 3), padding='same',
-                                         kernel_initializer=init)))
-        model.add(TimeDistributed(BatchNormalization()))
-        model.add(TimeDistributed(Activation('relu')))
+        model.add(Conv2D(kernel_filters, (3, 3), padding='same', kernel_initializer=init))
+        model.add(BatchNormalization())
+        model.add(Activation('relu'))
         # conv
-        model.add(TimeDistributed(Conv2D(kernel_filters, (3, 3), padding='same',
-                                         kernel_initializer=init)))
-        model.add(TimeDistributed(BatchNormalization()))
-        model.add(TimeDistributed(Activation('relu')))
+        model.add(Conv2D(kernel_filters, (3, 3), padding='same', kernel_initializer=init))
+        model.add(BatchNormalization())
+        model.add(Activation('relu'))
         # max pool
-        model.add(TimeDistributed(MaxPooling2D((2, 2), strides=(2, 2))))
+        model.add(MaxPooling2D((2, 2), strides=(2, 2)))
 
         return model
 
     initialiser = 'glorot_uniform'
     reg_lambda = model_config['L2_LAMBDA']
 
-    model = Sequential()
+    # Per-frame CNN, applied to all frames at once by a single TimeDistributed wrapper below
+    frame_cnn = Sequential(name='frame_cnn')
 
     # first (non-default) block
-    model.add(TimeDistributed(Conv2D(32, (7, 7), strides=(2, 2), padding='same',
-                                     kernel_initializer=initialiser),
-                              input_shape=input_shape))
-    model.add(TimeDistributed(BatchNormalization()))
-    model.add(TimeDistributed(Activation('relu')))
-    model.add(TimeDistributed(Conv2D(32, (3, 3), kernel_initializer=initialiser)))
-    model.add(TimeDistributed(BatchNormalization()))
-    model.add(TimeDistributed(Activation('relu')))
-    model.add(TimeDistributed(MaxPooling2D((2, 2), strides=(2, 2))))
+    frame_cnn.add(Conv2D(32, (7, 7), strides=(2, 2), padding='same', kernel_initializer=initialiser,
+                         input_shape=input_shape[1:]))
+    frame_cnn.add(BatchNormalization())
+    frame_cnn.add(Activation('relu'))
+    frame_cnn.add(Conv2D(32, (3, 3), kernel_initializer=initialiser))
+    frame_cnn.add(BatchNormalization())
+    frame_cnn.add(Activation('relu'))
+    frame_cnn.add(MaxPooling2D((2, 2), strides=(2, 2)))
 
     # 2nd-5th (default) blocks
-    model = add_default_block(model, 64, init=initialiser, reg_lambda=reg_lambda)
-    model = add_default_block(model, 128, init=initialiser, reg_lambda=reg_lambda)
-    model = add_default_block(model, 256, init=initialiser, reg_lambda=reg_lambda)
-    model = add_default_block(model, 512, init=initialiser, reg_lambda=reg_lambda)
+    frame_cnn = add_default_block(frame_cnn, 64, init=initialiser, reg_lambda=reg_lambda)
+    frame_cnn = add_default_block(frame_cnn, 128, init=initialiser, reg_lambda=reg_lambda)
+    frame_cnn = add_default_block(frame_cnn, 256, init=initialiser, reg_lambda=reg_lambda)
+    frame_cnn = add_default_block(frame_cnn, 512, init=initialiser, reg_lambda=reg_lambda)
+    frame_cnn.add(Flatten())
+
+    model = Sequential()
+    model.add(TimeDistributed(frame_cnn, input_shape=input_shape, name=frame_cnn.name))
 
     # LSTM output head
-    model.add(TimeDistributed(Flatten()))
     model.add(LSTM(256, return_sequences=False, dropout=0.5))
-    model.add(Dense(1, activation='sigmoid'))
+    model.add(Dense(1, activation='sigmoid', dtype='float32'))
 
-    model.summary()
+    if cfg['TRAIN']['MODEL_SUMMARY']:
+        model.summary()
 
-    model.compile(loss='binary_crossentropy', optimizer=Adam(learning_rate=model_config['LR']), metrics=metrics)
+    model.compile(loss='binary_crossentropy', optimizer=Adam(learning_rate=model_config['LR']), metrics=metrics,
+                  jit_compile=cfg['TRAIN']['XLA'])
 
     return model
 
@@ -347,10 +277,12 @@ def threeDCNN(model_config, input_shape, metrics, class_counts):
     model.add(Dense(32, activation='relu'))
     # model.add(Dropout(0.2))
 
-    model.add(Dense(1, activation='sigmoid'))
+    model.add(Dense(1, activation='sigmoid', dtype='float32'))
 
-    model.summary()
-    model.compile(loss='binary_crossentropy', optimizer=Adam(learning_rate=model_config['LR']), metrics=metrics)
+    if cfg['TRAIN']['MODEL_SUMMARY']:
+        model.summary()
+    model.compile(loss='binary_crossentropy', optimizer=Adam(learning_rate=model_config['LR']), metrics=metrics,
+                  jit_compile=cfg['TRAIN']['XLA'])
 
     return model
 
@@ -372,12 +304,43 @@ def res3d(model_config, input_shape, metrics, class_counts):
     dropout = model_config['DROPOUT']
     optimizer = Adam(learning_rate=lr)
 
-    output_bias = None
-    if cfg['TRAIN']['OUTPUT_BIAS']:
-        count0 = class_counts[0]
-        count1 = class_counts[1]
-        output_bias = math.log(count1 / count0)
-        output_bias = tf.keras.initializers.Constant(output_bias)
+    output_bias = output_bias_initializer(class_counts)
+
+    def conv(x, use_bias):
+        '''
+        Adds a 64-filter convolution with a (2, 3, 3) receptive field, factorized into (1, 3, 3) spatial and (2, 1, 1)
+        temporal convolutions if FACTORIZED is set. Nothing is placed between the two, so the pair stays linear - a
+        low-rank (2, 3, 3) convolution rather than a P3D block
+
+        :param x: Output tensor from previous layers
+        :param use_bias: Boolean, whether the (last) convolution has a bias
+
+        :return: Tensor - convolution output
+        '''
+
+        if model_config['FACTORIZED']:
+            x = Conv3D(filters=64, kernel_size=(1, 3, 3), strides=1, padding='same', use_bias=False)(x)
+            return Conv3D(filters=64, kernel_size=(2, 1, 1), strides=1, padding='same', use_bias=use_bias)(x)
+        return Conv3D(filters=64, kernel_size=(2, 3, 3), strides=1, padding='same', use_bias=use_bias)(x)
+
+    def res_block(x):
+        '''
+        Adds a residual block - conv, BN, relu, conv, add, relu, BN
+
+        :param x: Output tensor from previous layers
+
+        :return: Tensor - block output
+        '''
+
+        prev = x
+        x = conv(x, use_bias=False)
+        x = BatchNormalization()(x)
+        x = Activation(activation='relu')(x)
+        x = conv(x, use_bias=True)
+        x = Add()([x, prev])
+        x = Activation(activation='relu')(x)
+        x = BatchNormalization()(x)
+        return x
 
     inputs = Input(shape=input_shape)
 
@@ -388,33 +351,10 @@ def res3d(model_config, input_shape, metrics, class_counts):
     x = Conv3D(filters=64, kernel_size=(2, 3, 3), strides=1, activation='relu')(x)
     x = MaxPooling3D(pool_size=(2, 3, 3))(x)
     x = BatchNormalization()(x)
-    prev = x
 
-    # block 2 - conv, relu, BN, conv, add, relu, BN
-    x = Conv3D(filters=64, kernel_size=(2, 3, 3), strides=1, activation='relu', padding='same')(x)
-    x = BatchNormalization()(x)
-    x = Conv3D(filters=64, kernel_size=(2, 3, 3), strides=1, padding='same')(x)
-    x = Add()([x, prev])
-    x = Activation(activation='relu')(x)
-    x = BatchNormalization()(x)
-    prev = x
-
-    # block 3 - conv, relu, BN, conv, add, relu, BN
-    x = Conv3D(filters=64, kernel_size=(2, 3, 3), strides=1, activation='relu', padding='same')(x)
-    x = BatchNormalization()(x)
-    x = Conv3D(filters=64, kernel_size=(2, 3, 3), strides=1, padding='same')(x)
-    x = Add()([x, prev])
-    x = Activation(activation='relu')(x)
-    x = BatchNormalization()(x)
-    prev = x
-
-    # block 4 - conv, relu, BN, conv, add, relu, BN
-    x = Conv3D(filters=64, kernel_size=(2, 3, 3), strides=1, activation='relu', padding='same')(x)
-    x = BatchNormalization()(x)
-    x = Conv3D(filters=64, kernel_size=(2, 3, 3), strides=1, padding='same')(x)
-    x = Add()([x, prev])
-    x = Activation(activation='relu')(x)
-    x = BatchNormalization()(x)
+    # blocks 2 through 4 (residual)
+    for i in range(3):
+        x = res_block(x)
 
     # block 5 (output)
     x = GlobalAveragePooling3D()(x)
@@ -423,13 +363,28 @@ def res3d(model_config, input_shape, metrics, class_counts):
     outputs = Dense(1, activation='sigmoid', bias_initializer=output_bias, dtype='float32')(x)
 
     model = tf.keras.Model(inputs=inputs, outputs=outputs)
-    model.summary()
+    if cfg['TRAIN']['MODEL_SUMMARY']:
+        model.summary()
 
-    model.compile(loss='binary_crossentropy', optimizer=optimizer, metrics=metrics)
+    model.compile(loss='binary_crossentropy', optimizer=optimizer, metrics=metrics, jit_compile=cfg['TRAIN']['XLA'])
 
     return model
 
 
+@lru_cache(maxsize=4)
+def resnet50v2_base(input_shape):
+    '''
+    Builds an ImageNet-pretrained 2D ResNet50V2, once per input shape per process. Only safe to share because
+    inflated_resnet50 reads its layer names and weights without adding its layers to the new model
+
+    :param input_shape: Tuple, shape of an individual 2D input (without batch dimension)
+
+    :return: ResNet50V2 feature extractor with global average pooling
+    '''
+    return ResNet50V2(include_top=False, weights='imagenet', input_tensor=None, input_shape=input_shape,
+                      pooling='avg')
+
+
 def inflated_resnet50(model_config, input_shape, metrics, class_counts):
     '''
     Creates ResNet50 model inflated to 3 dimensions (as per Quo Vadis)
@@ -451,23 +406,18 @@ def inflated_resnet50(model_config, input_shape, metrics, class_counts):
     dropout = model_config['DROPOUT']
     l2_reg = model_config['L2_REG']
 
-    output_bias = None
-    if cfg['TRAIN']['OUTPUT_BIAS']:
-        count0 = class_counts[0]
-        count1 = class_counts[1]
-        output_bias = math.log(count1 / count0)
-        output_bias = tf.keras.initializers.Constant(output_bias)
+    output_bias = output_bias_initializer(class_counts)
 
     kernel_init = model_config['WEIGHT_INITIALIZER']
+    reg = L2(l2_reg)  # Shared by every convolution
 
     # Download 2D ResNet50
     if flow:
-        base = ResNet50V2(include_top=False, input_tensor=None, input_shape=(input_shape[1:3] + [3]), pooling='avg')
+        base = resnet50v2_base(tuple(input_shape[1:3]) + (3,))
     else:
-        base = ResNet50V2(include_top=False, weights='imagenet', input_tensor=None, input_shape=input_shape[1:],
-                          pooling='avg')
+        base = resnet50v2_base(tuple(input_shape[1:]))
 
-    def block(x, last, filters, ind, pos, l2, kernel_init):
+    def block(x, last, filters, ind, pos, reg, kernel_init):
 
         '''
         Adds layers corresponding to a ResNet50 block (inflated to 3D)
@@ -477,7 +427,7 @@ def inflated_resnet50(model_config, input_shape, metrics, class_counts):
         :param filters: Base number of filters in convolutions
         :param ind: Integer, tracking index of base ResNet50 layers (for naming purposes)
         :param pos: String, position of block in stage - either 'first', 'last', or a different arbitrary value
-        :param l2: L2 regularization penalty, applied to all convolutional layers
+        :param reg: L2 regularizer, applied to all convolutional layers
         :param kernel_init: Kernel initialization method
 
         :return: Tensor - block output
@@ -490,40 +440,40 @@ def inflated_resnet50(model_config, input_shape, metrics, class_counts):
             last = x
 
         x = Conv3D(filters=filters, kernel_size=1, strides=1, kernel_initializer=kernel_init,
-                   use_bias=False, kernel_regularizer=L2(l2), name=base.layers[ind + 2].name)(x)
+                   use_bias=False, kernel_regularizer=reg, name=base.layers[ind + 2].name)(x)
         x = BatchNormalization(name=base.layers[ind + 3].name)(x)
         x = Activation(activation='relu', name=base.layers[ind + 4].name)(x)
         x = ZeroPadding3D(padding=1, name=base.layers[ind + 5].name)(x)
 
         if pos == 'last':
             x = Conv3D(filters=filters, kernel_size=3, strides=2, kernel_initializer=kernel_init,
-                       use_bias=False, kernel_regularizer=L2(l2), name=base.layers[ind + 6].name)(x)
+                       use_bias=False, kernel_regularizer=reg, name=base.layers[ind + 6].name)(x)
         else:
             x = Conv3D(filters=filters, kernel_size=3, strides=1, kernel_initializer=kernel_init,
-                       use_bias=False, kernel_regularizer=L2(l2), name=base.layers[ind + 6].name)(x)
+                       use_bias=False, kernel_regularizer=reg, name=base.layers[ind + 6].name)(x)
         x = BatchNormalization(name=base.layers[ind + 7].name)(x)
         x = Activation(activation='relu', name=base.layers[ind + 8].name)(x)
 
         # ADD STUFF
         if pos == 'first':
             res = Conv3D(filters=filters * 4, kernel_size=1, strides=1, kernel_initializer=kernel_init,
-                         kernel_regularizer=L2(l2), name=base.layers[ind + 9].name)(last)
+                         kernel_regularizer=reg, name=base.layers[ind + 9].name)(last)
             x = Conv3D(filters=filters * 4, kernel_size=1, strides=1, kernel_initializer=kernel_init,
-                       kernel_regularizer=L2(l2), name=base.layers[ind + 10].name)(x)
+                       kernel_regularizer=reg, name=base.layers[ind + 10].name)(x)
             x = Add(name=base.layers[ind + 11].name)([x, res])
         elif pos == 'last':
             res = MaxPooling3D(pool_size=1, strides=2, name=base.layers[ind + 9].name)(last)
             x = Conv3D(filters=filters * 4, kernel_size=1, strides=1, kernel_initializer=kernel_init,
-                       kernel_regularizer=L2(l2), name=base.layers[ind + 10].name)(x)
+                       kernel_regularizer=reg, name=base.layers[ind + 10].name)(x)
             x = Add(name=base.layers[ind + 11].name)([x, res])
         else:
             x = Conv3D(filters=filters * 4, kernel_size=1, strides=1, kernel_initializer=kernel_init,
-                       kernel_regularizer=L2(l2), name=base.layers[ind + 9].name)(x)
+                       kernel_regularizer=reg, name=base.layers[ind + 9].name)(x)
             x = Add(name=base.layers[ind + 10].name)([x, last])
 
         return x
 
-    def stage(x, last, num_blocks, filters, ind, final, l2, kernel_init):
+    def stage(x, last, num_blocks, filters, ind, final, reg, kernel_init):
 
         '''
         Adds layers corresponding to a ResNet50 stage (inflated to 3D)
@@ -534,7 +484,7 @@ def inflated_resnet50(model_config, input_shape, metrics, class_counts):
         :param filters: Base number of filters in convolutions
         :param ind: Integer, tracking index of base ResNet50 layers (for naming purposes)
         :param final: Boolean, flagging whether final stage or not (final stage has no dimensional reduction)
-        :param l2: L2 regularization penalty
+        :param reg: L2 regularizer
         :param kernel_init: Kernel initialization method
 
         :return: Tuple of (stage output tensor, index for next layer to be added)
@@ -547,7 +497,7 @@ def inflated_resnet50(model_config, input_shape, metrics, class_counts):
             elif i == (num_blocks - 1):
                 if not final:
                     pos = 'last'
-            x = block(x, last, filters, ind, pos, l2, kernel_init)
+            x = block(x, last, filters, ind, pos, reg, kernel_init)
             last = x
             if (pos == 'first') or (pos == 'last'):
                 ind += 12
@@ -561,17 +511,17 @@ def inflated_resnet50(model_config, input_shape, metrics, class_counts):
     inputs = tf.keras.Input(shape=input_shape)
 
     x = ZeroPadding3D(padding=3, name=base.layers[1].name)(inputs)
-    x = Conv3D(filters=64, kernel_size=7, strides=2, kernel_initializer=kernel_init, kernel_regularizer=L2(l2_reg),
+    x = Conv3D(filters=64, kernel_size=7, strides=2, kernel_initializer=kernel_init, kernel_regularizer=reg,
                name=base.layers[2].name)(x)
     x = ZeroPadding3D(padding=1, name=base.layers[3].name)(x)
     x = MaxPooling3D(pool_size=3, strides=2, name=base.layers[4].name)(x)
 
     index = 5
 
-    x, index = stage(x, x, 3, 64, index, False, l2_reg, kernel_init)  # stage 1
-    x, index = stage(x, x, 4, 128, index, False, l2_reg, kernel_init)  # stage 2
-    x, index = stage(x, x, 6, 256, index, False, l2_reg, kernel_init)  # stage 3
-    # x, index = stage(x, x, 3, 512, index, True, l2_reg, kernel_init)  # stage 4
+    x, index = stage(x, x, 3, 64, index, False, reg, kernel_init)  # stage 1
+    x, index = stage(x, x, 4, 128, index, False, reg, kernel_init)  # stage 2
+    x, index = stage(x, x, 6, 256, index, False, reg, kernel_init)  # stage 3
+    # x, index = stage(x, x, 3, 512, index, True, reg, kernel_init)  # stage 4
 
     # Output head
     x = BatchNormalization(name=base.layers[-3].name)(x)
@@ -582,35 +532,39 @@ def inflated_resnet50(model_config, input_shape, metrics, class_counts):
                     dtype='float32')(x)
 
     model = tf.keras.Model(inputs=inputs, outputs=outputs)
-    model.summary()
+    if cfg['TRAIN']['MODEL_SUMMARY']:
+        model.summary()
 
     # Bootstrap weights & biases and freeze layers, only for convolutional and batch norm layers
     transfer = model_config['TRANSFER']
     if (not flow) and transfer:
 
-        for i in range(len(model.layers)):
+        weight_values = []  # (variable, value) pairs, assigned in a single batch after the loop
+        for new_layer in model.layers:
 
-            new_layer = model.layers[i]
             name = new_layer.name
 
             if '_conv' in name:
                 base_layer = base.get_layer(name)
                 orig_w = base_layer.get_weights()  # Params for corresponding 2D convolution from ResNet50
                 expand = base_layer.kernel_size[0]  # Kernel size of layer - let this be 'expand'
-                w = np.tile(orig_w[0], (expand, 1, 1, 1, 1))  # Duplicate corresponding 2D conv kernel 'expand' times
-                w = np.divide(w, expand)  # Divide by expansion amount to keep filter response constant
+                # Divide the 2D kernel by the expansion amount (to keep filter response constant), then repeat it
+                # 'expand' times along the new temporal axis as a broadcast view rather than a tiled copy
+                w = np.broadcast_to(orig_w[0] / expand, (expand,) + orig_w[0].shape)
                 if len(orig_w) == 1:  # if no biases, only set weights
-                    new_layer.set_weights([w])
+                    weight_values += zip(new_layer.weights, [w])
                 else:  # otherwise also take biases from corresponding 2D convolution layer
-                    new_layer.set_weights([w, orig_w[1]])
+                    weight_values += zip(new_layer.weights, [w, orig_w[1]])
             elif '_bn' in name:
                 if not (name == 'post_bn'):  # input shape of post_bn is different if not using whole ResNet
-                    new_layer.set_weights(base.get_layer(name).get_weights())
+                    weight_values += zip(new_layer.weights, base.get_layer(name).get_weights())
+
+        K.batch_set_value(weight_values)
 
-            if i < model_config['LAST_FROZEN']:
-                new_layer.trainable = False
+        for layer in model.layers[:model_config['LAST_FROZEN']]:
+            layer.trainable = False
 
-    model.compile(loss='binary_crossentropy', optimizer=optimizer, metrics=metrics)
+    model.compile(loss='binary_crossentropy', optimizer=optimizer, metrics=metrics, jit_compile=cfg['TRAIN']['XLA'])
 
     return model
 
@@ -638,84 +592,100 @@ def i3d(model_config, input_shapes, metrics, class_counts):
     dropout = model_config['DROPOUT']
     l2_reg = model_config['L2_REG']
 
-    output_bias = None
-    if cfg['TRAIN']['OUTPUT_BIAS']:
-        count0 = class_counts[0]
-        count1 = class_counts[1]
-        output_bias = math.log(count1 / count0)
-        output_bias = tf.keras.initializers.Constant(output_bias)
+    output_bias = output_bias_initializer(class_counts)
 
     kernel_init = model_config['WEIGHT_INITIALIZER']
+    reg = L2(l2_reg)  # Shared by every convolution
 
-    def inception_block(x, filters, l2):
+    def spatiotemporal_conv(x, filters, reg):
+        '''
+        Adds a (3, 3, 3) convolution with BN and relu, as depthwise and pointwise convolutions if SEPARABLE is set.
+        Assumes x already has 'filters' channels
+
+        :param x: Output tensor from previous layers
+        :param filters: Number of filters in convolutions
+        :param reg: L2 regularizer
+
+        :return: Tensor - convolution output
+        '''
+
+        if model_config['SEPARABLE']:
+            x = Conv3D(filters, kernel_size=(3, 3, 3), strides=1, groups=filters, kernel_initializer=kernel_init,
+                       kernel_regularizer=reg, padding='same', use_bias=False)(x)
+            x = BatchNormalization()(x)
+            x = Activation('relu')(x)
+            kernel_size = (1, 1, 1)
+        else:
+            kernel_size = (3, 3, 3)
+        x = Conv3D(filters, kernel_size=kernel_size, strides=1, kernel_initializer=kernel_init,
+                   kernel_regularizer=reg, padding='same', use_bias=False)(x)
+        x = BatchNormalization()(x)
+        x = Activation('relu')(x)
+        return x
+
+    def inception_block(x, filters, reg):
         a = Conv3D(filters, kernel_size=(1, 1, 1), strides=1, kernel_initializer=kernel_init,
-                   kernel_regularizer=L2(l2), padding='same', use_bias=False)(x)
+                   kernel_regularizer=reg, padding='same', use_bias=False)(x)
         a = BatchNormalization()(a)
         a = Activation('relu')(a)
 
         b = Conv3D(filters, kernel_size=(1, 1, 1), strides=1, kernel_initializer=kernel_init,
-                   kernel_regularizer=L2(l2), padding='same', use_bias=False)(x)
-        b = BatchNormalization()(b)
-        b = Activation('relu')(b)
-        b = Conv3D(filters, kernel_size=(3, 3, 3), strides=1, kernel_initializer=kernel_init,
-                   kernel_regularizer=L2(l2), padding='same', use_bias=False)(b)
+                   kernel_regularizer=reg, padding='same', use_bias=False)(x)
         b = BatchNormalization()(b)
         b = Activation('relu')(b)
+        b = spatiotemporal_conv(b, filters, reg)
 
         c = Conv3D(filters, kernel_size=(1, 1, 1), strides=1, kernel_initializer=kernel_init,
-                   kernel_regularizer=L2(l2), padding='same', use_bias=False)(x)
-        c = BatchNormalization()(c)
-        c = Activation('relu')(c)
-        c = Conv3D(filters, kernel_size=(3, 3, 3), strides=1, kernel_initializer=kernel_init,
-                   kernel_regularizer=L2(l2), padding='same', use_bias=False)(c)
+                   kernel_regularizer=reg, padding='same', use_bias=False)(x)
         c = BatchNormalization()(c)
         c = Activation('relu')(c)
+        c = spatiotemporal_conv(c, filters, reg)
 
         d = MaxPooling3D(pool_size=(3, 3, 3), strides=1, padding='same')(x)
         d = Conv3D(filters, kernel_size=(1, 1, 1), strides=1, kernel_initializer=kernel_init,
-                   kernel_regularizer=L2(l2), padding='same', use_bias=False)(d)
+                   kernel_regularizer=reg, padding='same', use_bias=False)(d)
         d = BatchNormalization()(d)
         d = Activation('relu')(d)
 
         return Concatenate()([a, b, c, d])
 
-    def inception(x, l2):
+    def inception(x, reg):
 
         # number of filters from inception paper - very deep CNNs for large scale image rec
 
         x = Conv3D(64, kernel_size=(7, 7, 7), strides=2, kernel_initializer=kernel_init,
-                   kernel_regularizer=L2(l2), use_bias=False)(x)
+                   kernel_regularizer=reg, use_bias=False)(x)
         x = BatchNormalization()(x)
         x = Activation('relu')(x)
 
         x = MaxPooling3D(pool_size=(1, 3, 3), strides=(1, 2, 2))(x)
 
         x = Conv3D(128, kernel_size=(1, 1, 1), strides=1, kernel_initializer=kernel_init,
-                   kernel_regularizer=L2(l2), use_bias=False)(x)
+                   kernel_regularizer=reg, use_bias=False)(x)
         x = BatchNormalization()(x)
         x = Activation('relu')(x)
         x = Conv3D(128, kernel_size=(3, 3, 3), strides=1, kernel_initializer=kernel_init,
-                   kernel_regularizer=L2(l2), use_bias=False)(x)
+                   kernel_regularizer=reg, use_bias=False)(x)
         x = BatchNormalization()(x)
         x = Activation('relu')(x)
 
         x = MaxPooling3D(pool_size=(1, 3, 3), strides=(1, 2, 2))(x)
 
         for i in range(2):
-            x = inception_block(x, 256, l2)
+            x = inception_block(x, 256, reg)
 
         x = MaxPooling3D(pool_size=(3, 3, 3), strides=(2, 2, 2))(x)
         '''
         for i in range(5):
-            x = inception_block(x, 512, l2)
+            x = inception_block(x, 512, reg)
 
         x = MaxPooling3D(pool_size=(2, 2, 2), strides=(2, 2, 2))(x)
 
         for i in range(2):
-            x = inception_block(x, 512, l2)
+            x = inception_block(x, 512, reg)
         '''
         x = Conv3D(512, kernel_size=(1, 1, 1), strides=1, kernel_initializer=kernel_init,
-                   kernel_regularizer=L2(l2), use_bias=False)(x)
+                   kernel_regularizer=reg, use_bias=False)(x)
         x = BatchNormalization()(x)
         x = Activation('relu')(x)
 
@@ -725,25 +695,33 @@ def i3d(model_config, input_shapes, metrics, class_counts):
 
     shape1 = clip_shape
     inputs1 = Input(shape1)
-    x1 = inputs1
-    x1 = inception(x1, l2_reg)
-    m1 = tf.keras.Model(inputs=inputs1, outputs=x1)
-
     shape2 = flow_shape
     inputs2 = Input(shape2)
-    x2 = inputs2
-    x2 = inception(x2, l2_reg)
-    m2 = tf.keras.Model(inputs=inputs2, outputs=x2)
 
-    x = Concatenate()([m1.output, m2.output])
+    if model_config['FUSED_STREAMS'] and (list(shape1[:3]) == list(shape2[:3])):
+        # Stack clip and flow channels and run a single backbone over both
+        x = Concatenate()([inputs1, inputs2])
+        x = inception(x, reg)
+    else:
+        x1 = inputs1
+        x1 = inception(x1, reg)
+        m1 = tf.keras.Model(inputs=inputs1, outputs=x1)
+
+        x2 = inputs2
+        x2 = inception(x2, reg)
+        m2 = tf.keras.Model(inputs=inputs2, outputs=x2)
+
+        x = Concatenate()([m1.output, m2.output])
     x = Dropout(dropout)(x)
     x = Dense(32, activation='relu')(x)
-    outputs = Dense(1, activation='sigmoid', kernel_initializer=kernel_init, bias_initializer=output_bias)(x)
+    outputs = Dense(1, activation='sigmoid', kernel_initializer=kernel_init, bias_initializer=output_bias,
+                    dtype='float32')(x)
 
-    model = tf.keras.Model(inputs=[m1.input, m2.input], outputs=outputs)
-    model.summary()
+    model = tf.keras.Model(inputs=[inputs1, inputs2], outputs=outputs)
+    if cfg['TRAIN']['MODEL_SUMMARY']:
+        model.summary()
 
-    model.compile(loss='binary_crossentropy', optimizer=optimizer, metrics=metrics)
+    model.compile(loss='binary_crossentropy', optimizer=optimizer, metrics=metrics, jit_compile=cfg['TRAIN']['XLA'])
 
     return model
 
@@ -772,21 +750,13 @@ def efficientnet(model_config, input_shape, metrics, class_counts):
     X_input = Input(input_shape, name='input')
     base_model = EfficientNet(include_top=False, weights='imagenet', input_shape=input_shape, input_tensor=X_input)
 
-    output_bias = None
+    output_bias = output_bias_initializer(class_counts)
     kernel_init = model_config['WEIGHT_INITIALIZER']
-    if cfg['TRAIN']['OUTPUT_BIAS']:
-        count0 = class_counts[0]
-        count1 = class_counts[1]
-        output_bias = math.log(count1 / count0)
-        output_bias = tf.keras.initializers.Constant(output_bias)
-
-    # Freeze layers
-    for i in range(len(base_model.layers)):
-        if i <= freeze_cutoff:
-            base_model.layers[i].trainable = False
-        # Freeze all batch norm layers
-        elif ('batch' in base_model.layers[i].name) or ('bn' in base_model.layers[i].name):
-            base_model.layers[i].trainable = False
+
+    # Freeze layers up to the cutoff, and all batch norm layers
+    for i, layer in enumerate(base_model.layers):
+        if (i <= freeze_cutoff) or isinstance(layer, BatchNormalization):
+            layer.trainable = False
 
     block_cutoff = ['top_activation', 'block6d_add', 'block5c_add', 'block4c_add']
     cutoff = block_cutoff[model_config['BLOCK_CUTOFF']]
@@ -801,10 +771,11 @@ def efficientnet(model_config, input_shape, metrics, class_counts):
     outputs = Activation('sigmoid', dtype='float32', name='output')(x)
 
     model = tf.keras.Model(inputs=X_input, outputs=outputs)
-    model.summary()
-    model.compile(loss=tfa.losses.SigmoidFocalCrossEntropy(reduction=tf.keras.losses.Reduction.AUTO,
+    if cfg['TRAIN']['MODEL_SUMMARY']:
+        model.summary()
+    model.compile(loss=tfa.losses.SigmoidFocalCrossEntropy(reduction=tf.keras.losses.Reduction.SUM_OVER_BATCH_SIZE,
                                                            alpha=model_config['ALPHA'], gamma=model_config['GAMMA']),
-                  optimizer=optimizer, metrics=metrics)
+                  optimizer=optimizer, metrics=metrics, jit_compile=cfg['TRAIN']['XLA'])
     return model
 
 
@@ -826,12 +797,7 @@ def xception(model_config, input_shape, metrics, class_counts):
     dropout = model_config['DROPOUT']
     l2_reg = model_config['L2_REG']
 
-    output_bias = None
-    if cfg['TRAIN']['OUTPUT_BIAS']:
-        count0 = class_counts[0]
-        count1 = class_counts[1]
-        output_bias = math.log(count1 / count0)
-        output_bias = tf.keras.initializers.Constant(output_bias)
+    output_bias = output_bias_initializer(class_counts)
 
     kernel_init = model_config['WEIGHT_INITIALIZER']
 
@@ -889,21 +855,20 @@ def xception(model_config, input_shape, metrics, class_counts):
 
     model = tf.keras.Model(inputs=base_model.inputs, outputs=outputs)
 
-    model.summary()
+    if cfg['TRAIN']['MODEL_SUMMARY']:
+        model.summary()
 
     # Freeze layers as specified if transfer learning is employed
     if transfer:
-        for i in range(len(model.layers)):
-            if i <= freeze_cutoff:
-                model.layers[i].trainable = False
-            # Freeze all batch norm layers
-            elif ('batch' in model.layers[i].name) or ('bn' in model.layers[i].name):
-                model.layers[i].trainable = False
+        # Freeze layers up to the cutoff, and all batch norm layers
+        for i, layer in enumerate(model.layers):
+            if (i <= freeze_cutoff) or isinstance(layer, BatchNormalization):
+                layer.trainable = False
 
     # model.compile(loss='binary_crossentropy', optimizer=optimizer, metrics=metrics)
-    model.compile(loss=tfa.losses.SigmoidFocalCrossEntropy(reduction=tf.keras.losses.Reduction.AUTO,
+    model.compile(loss=tfa.losses.SigmoidFocalCrossEntropy(reduction=tf.keras.losses.Reduction.SUM_OVER_BATCH_SIZE,
                                                            alpha=model_config['ALPHA'], gamma=model_config['GAMMA']),
-                  optimizer=optimizer, metrics=metrics)
+                  optimizer=optimizer, metrics=metrics, jit_compile=cfg['TRAIN']['XLA'])
 
     return model
 
@@ -927,12 +892,7 @@ def vit(model_config, input_shape, metrics, class_counts):
     dropout = model_config['DROPOUT']
     l2_reg = model_config['L2_REG']
 
-    output_bias = None
-    if cfg['TRAIN']['OUTPUT_BIAS']:
-        count0 = class_counts[0]
-        count1 = class_counts[1]
-        output_bias = math.log(count1 / count0)
-        output_bias = tf.keras.initializers.Constant(output_bias)
+    output_bias = output_bias_initializer(class_counts)
 
     kernel_init = model_config['WEIGHT_INITIALIZER']
 
@@ -1041,9 +1001,10 @@ def vit(model_config, input_shape, metrics, class_counts):
                     dtype='float32')(x)
 
     model = tf.keras.Model(inputs=inputs, outputs=outputs)
-    model.summary()
+    if cfg['TRAIN']['MODEL_SUMMARY']:
+        model.summary()
 
-    model.compile(loss='binary_crossentropy', optimizer=optimizer, metrics=metrics)
+    model.compile(loss='binary_crossentropy', optimizer=optimizer, metrics=metrics, jit_compile=cfg['TRAIN']['XLA'])
 
     return model
 
@@ -1073,11 +1034,12 @@ def variance_mmode_net(model_config, input_shape, metrics, class_counts):
     model.add(Dense(8, activation='relu'))
     model.add(Dropout(0.2))
     model.add(Dense(4, activation='relu'))
-    model.add(Dense(1, activation='sigmoid'))
+    model.add(Dense(1, activation='sigmoid', dtype='float32'))
 
-    model.summary()
+    if cfg['TRAIN']['MODEL_SUMMARY']:
+        model.summary()
 
-    model.compile(loss='binary_crossentropy', optimizer=optimizer, metrics=metrics)
+    model.compile(loss='binary_crossentropy', optimizer=optimizer, metrics=metrics, jit_compile=cfg['TRAIN']['XLA'])
 
     return model
 
@@ -1096,7 +1058,6 @@ def one_d_conv(model_config, input_shape, metrics, class_counts):
 
     model = Sequential([Input((224, 90, 3))])
     model.add(Lambda(lambda x: tf.image.rgb_to_grayscale(x)))
-    model.summary()
     model.add(Conv1D(64, kernel_size=3, activation='relu', strides=2))
     model.add(Conv1D(128, kernel_size=3, activation='relu', strides=2))
     model.add(Conv1D(128, kernel_size=3, activation='relu', strides=2))
@@ -1107,9 +1068,10 @@ def one_d_conv(model_config, input_shape, metrics, class_counts):
     model.add(Dropout(0.4))
     model.add(Dense(1, activation='sigmoid', dtype='float32'))
 
-    model.summary()
+    if cfg['TRAIN']['MODEL_SUMMARY']:
+        model.summary()
 
-    model.compile(loss='binary_crossentropy', optimizer=optimizer, metrics=metrics)
+    model.compile(loss='binary_crossentropy', optimizer=optimizer, metrics=metrics, jit_compile=cfg['TRAIN']['XLA'])
 
     return model
 
@@ -1131,9 +1093,28 @@ def mobile_net_v3_small(model_config, input_shape, metrics, class_counts):
                                   weights='imagenet',
                                   include_preprocessing=False)
 
-    model = Sequential([base_model, GlobalAveragePooling2D(), Dense(1, activation='sigmoid')])
-    model.summary()
+    model = Sequential([base_model, GlobalAveragePooling2D(), Dense(1, activation='sigmoid', dtype='float32')])
+    if cfg['TRAIN']['MODEL_SUMMARY']:
+        model.summary()
 
-    model.compile(loss='binary_crossentropy', optimizer=optimizer, metrics=metrics)
+    model.compile(loss='binary_crossentropy', optimizer=optimizer, metrics=metrics, jit_compile=cfg['TRAIN']['XLA'])
 
     return model
+
+
+# Model name -> (function returning compiled model, required preprocessing function), for get_model
+MODELS = {
+    'lrcn': (lrcn, normalize),
+    'threeDCNN': (threeDCNN, normalize),
+    'xception_raw': (xception_raw, xception_preprocess),
+    'vgg16': (vgg16, vgg16_preprocess),
+    'res3d': (res3d, normalize),
+    'inflated_resnet50': (inflated_resnet50, resnet_preprocess),
+    'i3d': (i3d, [normalize, normalize]),
+    'xception': (xception, xception_preprocess),
+    'vit': (vit, normalize),
+    'variance_mmode_net': (variance_mmode_net, normalize),
+    'one_d_conv': (one_d_conv, normalize),
+    'mobilenet_v3_small': (mobile_net_v3_small, mobilenet_v3_preprocess),
+    'efficientnet': (efficientnet, efficientnet_preprocess),
+}
@@ -5,26 +5,130 @@ Script for running predictions using trained models
 import datetime
 import os
 
+# oneDNN conv/matmul kernels are opt-in on CPU in TF 2.7, and must be enabled before TensorFlow is imported
+os.environ.setdefault('TF_ENABLE_ONEDNN_OPTS', '1')
+
 import pandas as pd
 from src.visualization.visualization import *
 from src.models.models import get_model
 from preprocessor import MModePreprocessor
 from tensorflow.keras.models import load_model
-from tensorflow.keras.metrics import Precision, Recall, AUC, TrueNegatives, TruePositives, FalseNegatives, \
-    FalsePositives, Accuracy
-from custom.metrics import Specificity
+from sklearn.metrics import roc_auc_score
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 cfg = yaml.full_load(open(os.path.join(os.getcwd(), '../config.yml'), 'r'))
 
 
-def predict_set(model, test_df, threshold=0.5, model_def_str=cfg['TRAIN']['MODEL_DEF']):
+def quantize_model(model, quantization, representative_set, n_calibration=100):
+    '''
+    Converts a trained model to TFLite with post-training quantization. The model keeps float inputs and outputs, which
+    it quantizes and dequantizes internally.
+    :param model: A trained TensorFlow model
+    :param quantization: 'int8' for full-integer quantization, or 'fp16' for float16 weights
+    :param representative_set: Batched dataset of preprocessed (input, label) pairs, used to calibrate int8 activation
+        ranges
+    :param n_calibration: Number of inputs to calibrate with
+    :return: Serialized TFLite model
+    '''
+
+    def representative_dataset():
+        for x, _ in representative_set.unbatch().take(n_calibration):
+            yield [tf.expand_dims(x, 0)]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'int8':
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    else:
+        converter.target_spec.supported_types = [tf.float16]
+    return converter.convert()
+
+
+def tflite_inference_fn(tflite_model):
+    '''
+    Loads a TFLite model into an interpreter, exposed as a function of one batch of inputs.
+    :param tflite_model: Serialized TFLite model
+    :return: Function mapping a batch of inputs to the model's outputs
+    '''
+    interpreter = tf.lite.Interpreter(model_content=tflite_model)
+    input_index = interpreter.get_input_details()[0]['index']
+    output_index = interpreter.get_output_details()[0]['index']
+    allocated_shape = []
+
+    def infer(x):
+        # Only reallocate when the batch shape changes (i.e. for the final, partial batch)
+        if allocated_shape != list(x.shape):
+            allocated_shape[:] = x.shape
+            interpreter.resize_tensor_input(input_index, allocated_shape)
+            interpreter.allocate_tensors()
+        interpreter.set_tensor(input_index, x.numpy())
+        interpreter.invoke()
+        return interpreter.get_tensor(output_index)
+
+    return infer
+
+
+def inference_fn(model):
+    '''
+    Traces a model's forward pass once for any batch size, so that batches of different sizes share one graph.
+    :param model: A trained TensorFlow model
+    :return: tf.function mapping a batch of inputs to the model's outputs
+    '''
+    return tf.function(lambda x: model(x, training=False),
+                       input_signature=[tf.TensorSpec(model.input_shape, tf.float32)],
+                       jit_compile=cfg['PREDICT']['XLA'])
+
+
+def predict_batches(infer, dataset, n_examples):
+    '''
+    Runs an inference function over a dataset one batch at a time, writing its outputs into a preallocated array.
+    :param infer: Function mapping a batch of inputs to the model's outputs
+    :param dataset: Batched dataset of preprocessed (input, label) pairs
+    :param n_examples: Number of examples in the dataset
+    :return: Array of model outputs, of shape (n_examples, 1)
+    '''
+    p = np.empty((n_examples, 1), dtype=np.float32)
+    start = 0
+    for x, _ in dataset:
+        p[start:start + len(x)] = infer(x)
+        start += len(x)
+    return p
+
+
+def warm_file_cache(filenames, n_workers):
+    '''
+    Reads files concurrently and discards their contents, so that they are in the OS page cache by the time the input
+    pipeline reads them. Overlapping the reads hides per-file disk latency for large sets of small npz files.
+    :param filenames: Paths of the files to read
+    :param n_workers: Number of concurrent reads
+    '''
+
+    def read(filename):
+        with open(filename, 'rb') as f:
+            while f.read(1 << 20):
+                pass
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        list(executor.map(read, filenames))
+
+
+# Inference function for each (model, quantization) pair that predict_set has been called with, so that later calls
+# skip re-tracing or re-converting the model
+inference_fns = {}
+
+
+def predict_set(model, test_df, threshold=0.5, model_def_str=cfg['TRAIN']['MODEL_DEF'],
+                quantization=cfg['PREDICT']['QUANTIZATION']):
     '''
     Given a dataset, make predictions for each constituent example.
     :param model: A trained TensorFlow model
     :param test_df: DataFrame containing npz files to predict
     :param threshold: Classification threshold
     :param model_def_str: Model name
+    :param quantization: 'none' to predict with the model as is, or 'int8'/'fp16' to predict with a quantized TFLite
+        conversion of it
     :return: List of predicted classes, array of prediction probabilities
     '''
 
@@ -36,14 +140,24 @@ def predict_set(model, test_df, threshold=0.5, model_def_str=cfg['TRAIN']['MODEL
     #       and labels so that TensorFlow can perform dynamic loading.
     dataset = tf.data.Dataset.from_tensor_slices((test_df['filename'].tolist(), test_df['label']))
     preprocessor = MModePreprocessor(preprocessing_fn)
+    preprocessor.batch_size = cfg['PREDICT']['BATCH_SIZE']
+    if cfg['PREDICT']['CACHE_WARMING_WORKERS'] > 0:
+        warm_file_cache(test_df['filename'], cfg['PREDICT']['CACHE_WARMING_WORKERS'])
 
     preprocessed_set = preprocessor.prepare(dataset, test_df, shuffle=False, augment=False)
     # Obtain prediction probabilities and classes
-    p = model.predict(preprocessed_set, verbose=1)
+    if (model, quantization) not in inference_fns:
+        if quantization in ['int8', 'fp16']:
+            infer = tflite_inference_fn(quantize_model(model, quantization, preprocessed_set))
+        else:
+            infer = inference_fn(model)
+        inference_fns[(model, quantization)] = infer
+    p = predict_batches(inference_fns[(model, quantization)], preprocessed_set, len(test_df))
 
-    pred_classes = (p[:, 0] >= threshold).astype(int)
+    probs = p[:, 0]
+    pred_classes = (probs >= threshold).astype(np.int8)
 
-    return pred_classes, np.squeeze(p, axis=1)
+    return pred_classes, probs
 
 
 def export_predictions(df, pred_classes, probs):
@@ -54,27 +168,34 @@ def export_predictions(df, pred_classes, probs):
     :param probs: List of probabilities
     '''
 
-    pred_df = pd.DataFrame(columns=['id', 'Predicted Class', 'Probability'])
-    pred_df['id'] = df['id']
-    pred_df['Ground Truth'] = df['label']
-    pred_df['Predicted Class'] = pred_classes
-    pred_df['Probability'] = probs
+    pred_df = pd.DataFrame({'id': df['id'].to_numpy(), 'Predicted Class': pred_classes, 'Probability': probs,
+                            'Ground Truth': df['label'].to_numpy()})
     pred_df.to_csv(os.path.join(os.getcwd(),
                                 cfg['PREDICT']['PREDICTIONS_OUT'], datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
                                 + '_predictions.csv'), index=False)
 
 
 def export_metrics(df, probs):
-    metrics = [Accuracy, AUC, Recall, Specificity, Precision, TrueNegatives, TruePositives, FalseNegatives,
-               FalsePositives]
-    results = []
-    metric_names = []
-    for metric in metrics:
-        m = metric()
-        m.update_state(df['label'], probs)
-        results += [m.result().numpy()]
-        metric_names += [m.name]
-    res_df = pd.DataFrame([results], columns=metric_names)
+    '''
+    Export test set metrics to csv, all derived from one confusion matrix of the thresholded probabilities
+    :param df: DataFrame of npz files
+    :param probs: List of probabilities
+    '''
+
+    labels = df['label'].to_numpy().astype(int)
+    preds = (np.asarray(probs) > 0.5).astype(int)  # Same thresholding as the Keras metrics
+    tn, fp, fn, tp = np.bincount(labels * 2 + preds, minlength=4)
+
+    def ratio(num, den):
+        return num / den if den > 0 else 0.0
+
+    # AUC is undefined with only one class present - report 0, as the Keras AUC metric did
+    auc = roc_auc_score(labels, probs) if len(np.unique(labels)) > 1 else 0.0
+
+    res_df = pd.DataFrame([{'accuracy': (tp + tn) / len(labels), 'auc': auc,
+                            'recall': ratio(tp, tp + fn), 'specificity': ratio(tn, tn + fp),
+                            'precision': ratio(tp, tp + fp), 'true_negatives': tn, 'true_positives': tp,
+                            'false_negatives': fn, 'false_positives': fp}])
     res_df.to_csv(os.path.join(os.getcwd(),
                                cfg['PREDICT']['PREDICTIONS_OUT'], datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
                                + '_metrics.csv'), index=False)
@@ -91,13 +212,14 @@ def clock_avg_runtime(n_gpu_warmup_runs, n_experiment_runs):
     times = np.zeros((n_experiment_runs))
     img_dim = (cfg['PREPROCESS']['PARAMS']['IMG_SIZE'][0], cfg['PREPROCESS']['PARAMS']['M_MODE_WIDTH'])
     model = load_model(os.path.join('..', cfg['PREDICT']['MODEL']), compile=False)
+    infer = inference_fn(model)
     for i in range(n_gpu_warmup_runs):
         x = tf.random.normal((1, img_dim[0], img_dim[1], 3))
-        y = model(x)
+        y = infer(x)
     for i in range(n_experiment_runs):
         x = tf.random.normal((1, img_dim[0], img_dim[1], 3))
         t_start = time.time()
-        y = model(x)
+        y = infer(x).numpy()  # Wait for the result, so that the whole forward pass is timed
         times[i] = time.time() - t_start
     t_avg_ms = np.mean(times) * 1000
     t_std_ms = np.std(times) * 1000
@@ -106,6 +228,9 @@ def clock_avg_runtime(n_gpu_warmup_runs, n_experiment_runs):
 
 
 if __name__ == '__main__':
+    # Size TensorFlow's thread pools before the first op runs, as they are fixed afterwards
+    tf.config.threading.set_intra_op_parallelism_threads(cfg['PREDICT']['INTRA_OP_THREADS'])
+    tf.config.threading.set_inter_op_parallelism_threads(cfg['PREDICT']['INTER_OP_THREADS'])
     test_df = pd.read_csv(cfg['PREDICT']['TEST_DF'])
     model = load_model(os.path.join('..', cfg['PREDICT']['MODEL']), compile=False)
     pred_labels, probs = predict_set(model, test_df)
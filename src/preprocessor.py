@@ -9,7 +9,8 @@ from copy import deepcopy
 import cv2
 
 # cfg = yaml.full_load(open(os.getcwd() + '/../config.yml', 'r'))
-cfg = yaml.full_load(open(os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'config.yml')), 'r'))
+cfg = yaml.load(open(os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'config.yml')), 'r'),
+                Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 
 
 def random_flip_left_right_clip(x):
@@ -413,6 +414,20 @@ def get_middle_pixel_index_brightest_vertical_sum_sampled(image, bounding_box, o
     return middle_pixel_index + new_xmin
 
 
+def pipeline_options(deterministic=True):
+    '''
+    Options that let tf.data's static optimizer fuse and parallelize the stages of a loading/preprocessing pipeline
+    :param deterministic: Whether elements must be produced in order (unnecessary for shuffled datasets)
+    :return: tf.data.Options to be applied to a dataset with with_options()
+    '''
+    options = tf.data.Options()
+    options.experimental_optimization.map_fusion = True
+    options.experimental_optimization.map_parallelization = True
+    options.experimental_optimization.parallel_batch = True
+    options.deterministic = deterministic
+    return options
+
+
 # PREPROCESSOR CLASS THAT HANDLES NO LABELS - FOR HOLDOUTS???
 
 
@@ -460,6 +475,9 @@ class Preprocessor:
         # Allows later elements to be prepared while the current element is being processed
         ds = ds.prefetch(buffer_size=self.autotune)
 
+        # Fuse and parallelize the pipeline's stages - shuffled datasets needn't preserve order
+        ds = ds.with_options(pipeline_options(deterministic=not shuffle))
+
         return ds
 
 
@@ -509,4 +527,7 @@ class MModePreprocessor:
         # Allows later elements to be prepared while the current element is being processed
         ds = ds.prefetch(buffer_size=self.autotune)
 
+        # Fuse and parallelize the pipeline's stages - shuffled datasets needn't preserve order
+        ds = ds.with_options(pipeline_options(deterministic=not shuffle))
+
         return ds
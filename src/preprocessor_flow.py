@@ -4,7 +4,8 @@ import yaml
 import tensorflow as tf
 import preprocessor
 
-cfg = yaml.full_load(open(os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'config.yml')), 'r'))
+cfg = yaml.load(open(os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'config.yml')), 'r'),
+                Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 
 
 def augment_flow(x):
@@ -146,6 +147,9 @@ class FlowPreprocessor:
         # Allows later elements to be prepared while the current element is being processed
         ds = ds.prefetch(buffer_size=self.autotune)
 
+        # Fuse and parallelize the pipeline's stages - shuffled datasets needn't preserve order
+        ds = ds.with_options(preprocessor.pipeline_options(deterministic=not shuffle))
+
         return ds
 
 
@@ -198,5 +202,8 @@ class TwoStreamPreprocessor:
         # Allows later elements to be prepared while the current element is being processed
         ds = ds.prefetch(buffer_size=self.autotune)
 
+        # Fuse and parallelize the pipeline's stages - shuffled datasets needn't preserve order
+        ds = ds.with_options(preprocessor.pipeline_options(deterministic=not shuffle))
+
         return ds
 
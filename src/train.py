@@ -27,21 +27,21 @@ from skopt.callbacks import CheckpointSaver
 from skopt import load
 import gc
 
-cfg = yaml.full_load(open(os.path.join(os.getcwd(), '../config.yml'), 'r'))
+# Config is found relative to this file rather than the cwd, and parsed with LibYAML's loader where it is available
+cfg = yaml.load(open(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'config.yml'), 'r'),
+                Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 
 
-def log_test_results(model, test_set, test_df, test_metrics, writer):
+def log_test_results(test_predictions, test_df, test_metrics, writer):
     '''
     Visualize performance of a trained model on the test set. Optionally save the model.
-    :param model: A trained TensorFlow model
-    :param test_set: A TensorFlow dataset for the test set
+    :param test_predictions: The trained model's predictions on the test set
     :param test_df: Dataframe containing npz files and labels for test set
     :param test_metrics: Dict of test set performance metrics
     :param writer: file writer object for tensorboard
     '''
 
     # Visualization of test results
-    test_predictions = model.predict(test_set, verbose=0)
     labels = test_df['label'].to_numpy()
     plt = plot_roc(labels, test_predictions, [0, 1])
     roc_img = plot_to_tensor()
@@ -62,55 +62,50 @@ def log_test_results(model, test_set, test_df, test_metrics, writer):
     return
 
 
-def log_miniclip_test_results(model, test_set, test_df, writer):
+def log_miniclip_test_results(test_predictions, test_df, writer):
     '''
     Adjust and log clip and mini-clip prediction results - if any mini-clip is sliding, then entire clip is sliding
-    :param model: A trained TensorFlow model
-    :param test_set: A TensorFlow dataset for the test set
+    :param test_predictions: The trained model's predictions on the test set
     :param test_df: Dataframe containing npz files and labels for test set
     :param writer: file writer object for tensorboard
     '''
 
-    # Get predictions
-    test_predictions = model.predict(test_set, verbose=0)
     df_copy = test_df.copy()
 
     # get parent clip ids
-    clip_ids = []
-    for idx, row in test_df.iterrows():
-        clip_ids.append(row['id'].split('_')[0])
-    df_copy.loc[:, 'clip_id'] = clip_ids
+    df_copy.loc[:, 'clip_id'] = test_df['id'].str.split('_').str[0]
     df_copy.loc[:, 'pred'] = np.where(test_predictions >= 0.5, 1, 0)
 
-    # go through each parent clip and reassign miniclip predictions (if any miniclip is sliding, all are sliding)
-    # also create labels and predictions for clips only
-    clips = pd.unique(df_copy['clip_id'])
-    clip_labels = []
-    clip_preds = []
-    for clip_id in clips:
-        # get all miniclips belonging to parent clip
-        miniclips = df_copy[df_copy['clip_id'] == clip_id]
+    # create labels and predictions for clips only, from the first miniclip of each parent clip (before reassignment)
+    clips = df_copy.drop_duplicates('clip_id')
+    clip_labels = clips['label'].tolist()
+    clip_preds = clips['pred'].tolist()
 
-        # assing label of 1 to all miniclips if any miniclip has label of 1
-        if any(miniclips['pred'] == 1):
-            df_copy.loc[df_copy['clip_id'] == clip_id, 'pred'] = [1] * len(miniclips)
-
-        clip_labels.append(miniclips.iloc[0]['label'])
-        clip_preds.append(miniclips.iloc[0]['pred'])
+    # reassign miniclip predictions of each parent clip in one pass (if any miniclip is sliding, all are sliding)
+    df_copy.loc[:, 'pred'] = df_copy.groupby('clip_id')['pred'].transform('max')
 
     metrics = [Accuracy, AUC, Recall, Specificity, TrueNegatives, TruePositives, FalseNegatives, FalsePositives]
 
+    # Compute metrics for adjusted miniclips and clips, with inputs converted to tensors once
+    miniclip_labels, miniclip_preds = tf.constant(df_copy['label'].to_numpy()), tf.constant(df_copy['pred'].to_numpy())
+    clip_labels, clip_preds = tf.constant(clip_labels), tf.constant(clip_preds)
+    miniclip_metrics = [metric() for metric in metrics]
+    clip_metrics = [metric() for metric in metrics]
+    for m in miniclip_metrics:
+        m.update_state(miniclip_labels, miniclip_preds)
+    for m in clip_metrics:
+        m.update_state(clip_labels, clip_preds)
+
+    # Fetch all results from the device at once, rather than one metric at a time
+    miniclip_results = tf.stack([m.result() for m in miniclip_metrics]).numpy()
+    clip_results = tf.stack([m.result() for m in clip_metrics]).numpy()
+
     # Create table of metrics for adjusted clips and miniclips
     miniclip_summary_str = [['**Metric**', '**Value**']]
     clip_summary_str = [['**Metric**', '**Value**']]
-    for metric in metrics:
-        m = metric()
-        m.update_state(df_copy['label'], df_copy['pred'])
-        miniclip_summary_str.append([m.name, str(m.result().numpy())])
-
-        m.reset_state()
-        m.update_state(clip_labels, clip_preds)
-        clip_summary_str.append([m.name, str(m.result().numpy())])
+    for m, miniclip_result, clip_result in zip(miniclip_metrics, miniclip_results, clip_results):
+        miniclip_summary_str.append([m.name, str(miniclip_result)])
+        clip_summary_str.append([m.name, str(clip_result)])
 
     # Write to TensorBoard logs
     with writer.as_default():
@@ -191,12 +186,23 @@ def train_model(model_def_str=cfg['TRAIN']['MODEL_DEF'],
     :param log_name: Optionally include a name to be added to the filename of the logs for this training run
     '''
 
-    # Enable mixed precision
+    # Enable mixed precision. Under 'mixed_float16', model.compile wraps the optimizer in a LossScaleOptimizer
     mixed_precision = cfg['TRAIN']['MIXED_PRECISION']
     if mixed_precision:
-        policy = tf.keras.mixed_precision.Policy('mixed_float16')
+        policy = tf.keras.mixed_precision.Policy(cfg['TRAIN']['MIXED_PRECISION_POLICY'])
         tf.keras.mixed_precision.set_global_policy(policy)
 
+    # Enable XLA JIT compilation, fusing the model's conv/batch norm/activation kernels
+    if cfg['TRAIN']['XLA']:
+        tf.config.optimizer.set_jit(True)
+
+    # Optionally replicate the model across all visible GPUs, with each batch split between them (the default strategy
+    # places everything on a single device)
+    if cfg['TRAIN']['MULTI_GPU']:
+        strategy = tf.distribute.MirroredStrategy()
+    else:
+        strategy = tf.distribute.get_strategy()
+
     flow = cfg['PREPROCESS']['PARAMS']['FLOW']
     m_mode = cfg['TRAIN']['M_MODE']
 
@@ -243,6 +249,7 @@ def train_model(model_def_str=cfg['TRAIN']['MODEL_DEF'],
         preprocessor = TwoStreamPreprocessor(preprocessing_fn)
     else:
         preprocessor = Preprocessor(preprocessing_fn)
+    preprocessor.batch_size *= strategy.num_replicas_in_sync  # Keep the per-device batch size as configured
 
     # Define the preprocessing pipelines for train, test and validation
     train_set = preprocessor.prepare(train_set, train_df, shuffle=True, augment=True)
@@ -263,12 +270,6 @@ def train_model(model_def_str=cfg['TRAIN']['MODEL_DEF'],
 
     counts = [num_no_sliding, num_sliding]
 
-    # Defining Binary Classification Metrics
-    metrics = ['accuracy', AUC(name='auc'), FBetaScore(num_classes=2, average='micro', threshold=0.5)]
-    metrics += [Precision(name='precision'), Recall(name='recall')]
-    metrics += [TrueNegatives(), TruePositives(), FalseNegatives(), FalsePositives(), Specificity(name='specificity'),
-                PhiCoefficient(), SensitivityAtSpecificity(0.95)]
-
     # Get the model
     if m_mode:
         input_shape = [cfg['PREPROCESS']['PARAMS']['IMG_SIZE'][0], cfg['PREPROCESS']['PARAMS']['M_MODE_WIDTH'], 3]
@@ -280,7 +281,16 @@ def train_model(model_def_str=cfg['TRAIN']['MODEL_DEF'],
         input_shape = [input_shape]
         input_shape.append([cfg['PREPROCESS']['PARAMS']['WINDOW']] + cfg['PREPROCESS']['PARAMS']['IMG_SIZE'] + [2])
 
-    model = model_def_fn(hparams, input_shape, metrics, counts)
+    # Metric, model and optimizer variables are created within the strategy's scope, so that they can be mirrored
+    with strategy.scope():
+
+        # Defining Binary Classification Metrics
+        metrics = ['accuracy', AUC(name='auc'), FBetaScore(num_classes=2, average='micro', threshold=0.5)]
+        metrics += [Precision(name='precision'), Recall(name='recall')]
+        metrics += [TrueNegatives(), TruePositives(), FalseNegatives(), FalsePositives(),
+                    Specificity(name='specificity'), PhiCoefficient(), SensitivityAtSpecificity(0.95)]
+
+        model = model_def_fn(hparams, input_shape, metrics, counts)
 
     # Refresh the TensorBoard directory
     tensorboard_path = cfg['TRAIN']['PATHS']['TENSORBOARD']
@@ -302,24 +312,16 @@ def train_model(model_def_str=cfg['TRAIN']['MODEL_DEF'],
     # Learning rate scheduler & logging LR
     writer1 = tf.summary.create_file_writer(log_dir + '/train')
 
-    def scheduler(epoch, lr):
-        '''
-        Returns learning rate for the upcoming epoch based on a set schedule
-        Decreases learning rate by a factor of e^-(DECAY_VAL) starting at epoch 15
-
-        :param epoch: Integer, training epoch number
-        :param lr: Float, current learning rate
-
-        :return: Float, new learning rate
-        '''
-        learning_rate = lr
-        if epoch > hparams['LR_DECAY_EPOCH']:
-            learning_rate = lr * tf.math.exp(-1 * hparams['LR_DECAY_VAL'])
-        with writer1.as_default():  # Write LR scalar to log directory
+    # Learning rate for every epoch, precomputed from the optimizer's initial learning rate
+    # Decreases learning rate by a factor of e^-(DECAY_VAL) every epoch after epoch LR_DECAY_EPOCH
+    initial_lr = float(tf.keras.backend.get_value(model.optimizer.learning_rate))
+    decay_epochs = np.maximum(np.arange(cfg['TRAIN']['PARAMS']['EPOCHS']) - hparams['LR_DECAY_EPOCH'], 0)
+    lr_schedule = (initial_lr * np.exp(-1 * hparams['LR_DECAY_VAL'] * decay_epochs)).tolist()
+    with writer1.as_default():  # Write the LR schedule to log directory once, rather than from within every epoch
+        for epoch, learning_rate in enumerate(lr_schedule):
             tf.summary.scalar('learning rate', data=learning_rate, step=epoch)
-        return learning_rate
 
-    lr_callback = tf.keras.callbacks.LearningRateScheduler(scheduler)
+    lr_callback = tf.keras.callbacks.LearningRateScheduler(lambda epoch: lr_schedule[epoch])
 
     # Creating a ModelCheckpoint for saving the model
     model_out_dir += time
@@ -364,8 +366,10 @@ def train_model(model_def_str=cfg['TRAIN']['MODEL_DEF'],
             test_metrics[metric] = value
             test_summary_str.append([metric, str(value)])
         if log_dir is not None:
-            log_test_results(model, test_set, test_df, test_metrics, writer2)
-            log_miniclip_test_results(model, test_set, test_df, writer2)
+            # Predict the test set once and share the predictions between both logs
+            test_predictions = model.predict(test_set, verbose=0)
+            log_test_results(test_predictions, test_df, test_metrics, writer2)
+            log_miniclip_test_results(test_predictions, test_df, writer2)
     else:
         test_results = model.evaluate(val_set, verbose=1)
         test_summary_str = [['**Metric**', '**Value**']]
@@ -373,8 +377,9 @@ def train_model(model_def_str=cfg['TRAIN']['MODEL_DEF'],
             test_metrics[metric] = value
             test_summary_str.append([metric, str(value)])
         if log_dir is not None:
-            log_test_results(model, val_set, val_df, test_metrics, writer2)
-            log_miniclip_test_results(model, val_set, val_df, writer2)
+            val_predictions = model.predict(val_set, verbose=0)
+            log_test_results(val_predictions, val_df, test_metrics, writer2)
+            log_miniclip_test_results(val_predictions, val_df, writer2)
 
     # Adding error indicator, helpful for hparam search or cross val experiment
     test_metrics['err'] = err
@@ -389,16 +394,14 @@ def partition_k_fold(df):
 
     n_folds = cfg['CROSS_VAL']['N_FOLDS']
 
-    # get unique patients
-    all_pts = df['patient_id'].unique()
+    # get unique patients (in order of appearance), each labelled by its first mini-clip
+    first_clips = df.drop_duplicates('patient_id')
+    all_pts = first_clips['patient_id'].to_numpy()
+    labels = first_clips['label'].tolist()
     val_split = 1.0 / n_folds
     cfg['TRAIN']['SPLITS']['VAL'] = val_split
     cfg['TRAIN']['SPLITS']['TEST'] = 0.
     pt_k_fold = StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=cfg['TRAIN']['SPLITS']['RANDOM_SEED'])
-
-    labels = []
-    for patient in all_pts:
-        labels.append(df[df['patient_id'] == patient]['label'].iloc[0])
     return pt_k_fold, all_pts, labels
 
 
@@ -508,8 +511,9 @@ def bayesian_hparam_optimization(checkpoint=None, df=None, cross_val_runs=0):
             # Partition into training and validation sets for this fold. Save the partitions.
             train_pts = all_pts[train_index]
             val_pts = all_pts[val_index]
-            train_df = df[df['patient_id'].isin(train_pts)]
-            val_df = df[df['patient_id'].isin(val_pts)]
+            val_mask = df['patient_id'].isin(val_pts)  # Folds are complementary, so one membership test splits both
+            train_df = df[~val_mask]
+            val_df = df[val_mask]
 
             train_dfs.append(train_df)
             val_dfs.append(val_df)
@@ -600,8 +604,6 @@ def cross_validation(df=None, hparams=None):
     '''
 
     cur_date = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
-    csv_path = os.path.join(os.getcwd(), 'data/', cfg['PREPROCESS']['PATHS']['CSVS_OUTPUT'])
-    npz_dir = cfg['PREPROCESS']['PATHS']['NPZ']
     n_folds = cfg['CROSS_VAL']['N_FOLDS']
 
     metrics = cfg['CROSS_VAL']['METRICS']
@@ -626,8 +628,9 @@ def cross_validation(df=None, hparams=None):
         # Partition into training and validation sets for this fold. Save the partitions.
         train_pts = all_pts[train_index]
         val_pts = all_pts[val_index]
-        train_df = df[df['patient_id'].isin(train_pts)]
-        val_df = df[df['patient_id'].isin(val_pts)]
+        val_mask = df['patient_id'].isin(val_pts)  # Folds are complementary, so one membership test splits both
+        train_df = df[~val_mask]
+        val_df = df[val_mask]
 
         train_df.to_csv(os.path.join(partition_path, 'fold_' + str(cur_fold) + '_train_set.csv'), index=False)
         val_df.to_csv(os.path.join(partition_path, 'fold_' + str(cur_fold) + '_val_set.csv'), index=False)
@@ -645,10 +648,10 @@ def cross_validation(df=None, hparams=None):
         tf.keras.backend.clear_session()
         del model
 
-    # Record mean and standard deviation of test set results
-    for metric in metrics:
-        metrics_df[metric][n_folds] = metrics_df[metric][0:-2].mean()
-        metrics_df[metric][n_folds + 1] = metrics_df[metric][0:-2].std()
+    # Record mean and standard deviation of test set results, for all metrics at once
+    fold_results = metrics_df.loc[:n_folds - 1, metrics]
+    metrics_df.loc[n_folds, metrics] = fold_results.mean()
+    metrics_df.loc[n_folds + 1, metrics] = fold_results.std()
 
     # Save results
     file_path = os.path.join(cfg['TRAIN']['PATHS']['EXPERIMENTS'], 'cross_val_' + model_name + cur_date + '.csv')
@@ -13,7 +13,8 @@ import datetime
 from sklearn.metrics import confusion_matrix, roc_curve
 from skopt.plots import plot_objective
 
-cfg = yaml.full_load(open(os.path.join(os.getcwd(), '../config.yml'), 'r'))
+cfg = yaml.load(open(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'config.yml'), 'r'),
+                Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 
 def plot_roc(labels, predictions, class_name_list, dir_path=None, title=None):
     '''